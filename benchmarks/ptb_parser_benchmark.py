@@ -0,0 +1,77 @@
+# NNBlocks is a Deep Learning framework for computational linguistics.
+#
+#   Copyright (C) 2015 Frederico Tommasi Caroli
+#
+#   NNBlocks is free software: you can redistribute it and/or modify it under
+#   the terms of the GNU General Public License as published by the Free
+#   Software Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   NNBlocks is distributed in the hope that it will be useful, but WITHOUT ANY
+#   WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+#   FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+#   details.
+#
+#   You should have received a copy of the GNU General Public License along with
+#   NNBlocks. If not, see http://www.gnu.org/licenses/.
+
+"""Compares PTBParser and parse_tree on a treebank file.
+Usage:
+    python benchmarks/ptb_parser_benchmark.py [treebank_file]
+The file must have one tree per line. Without a file, random binary trees in
+the Stanford Sentiment Treebank format are generated.
+"""
+import gc
+import sys
+import time
+import random
+from nnb.utils.ptb import PTBParser, parse_tree
+
+def random_tree(rng, leaves):
+    if leaves == 1:
+        return '({0} w{1})'.format(rng.randint(0, 4), rng.randint(0, 20000))
+    left = rng.randint(1, leaves - 1)
+    return '({0} {1} {2})'.format(rng.randint(0, 4),
+                                    random_tree(rng, left),
+                                    random_tree(rng, leaves - left))
+
+def same_tree(a, b):
+    if a.label != b.label or type(a.value) != type(b.value):
+        return False
+    if not isinstance(a.value, list):
+        return a.value == b.value
+    return len(a.value) == len(b.value) and \
+            all(same_tree(x, y) for x, y in zip(a.value, b.value))
+
+def main():
+    if len(sys.argv) > 1:
+        with open(sys.argv[1]) as f:
+            lines = f.readlines()
+    else:
+        rng = random.Random(1234)
+        lines = [random_tree(rng, rng.randint(5, 50)) for _ in xrange(10000)]
+
+    #Like timeit, keep the garbage collector from timing the trees we hold
+    gc.disable()
+    start = time.time()
+    parser = PTBParser()
+    old_trees = [parser.parse(line) for line in lines]
+    old_time = time.time() - start
+
+    start = time.time()
+    new_trees = [parse_tree(line) for line in lines]
+    new_time = time.time() - start
+    gc.enable()
+
+    for old, new in zip(old_trees, new_trees):
+        if (old is None) != (new is None) or \
+                (old is not None and not same_tree(old, new)):
+            raise AssertionError("The parsers built different trees")
+
+    print "Trees: {0}".format(len(lines))
+    print "PTBParser:  {0:.3f}s".format(old_time)
+    print "parse_tree: {0:.3f}s".format(new_time)
+    print "Speedup:    {0:.1f}x".format(old_time / new_time)
+
+if __name__ == '__main__':
+    main()
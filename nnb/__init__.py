@@ -26,19 +26,29 @@ from model import (
     Picker,
     ConcatenationModel,
     CustomModel,
-    SliceModel
+    SliceModel,
+    is_training
 )
 import activation
 import cost
+import pooling
+from pooling import (
+    MaxOverTimePoolingLayer,
+    KMaxPoolingLayer,
+    DynamicPoolingLayer
+)
 import train
 from nn_model import (
     PerceptronLayer,
     SoftmaxLayer,
+    HierarchicalSoftmaxLayer,
+    SampledSoftmaxLayer,
     RecursiveNeuralNetwork,
     RecurrentNeuralNetwork,
     SimpleRecurrence,
     LSTMRecurrence,
     ConvolutionalLayer,
+    ConvolutionalBank,
     MaxPoolingLayer,
     DropoutLayer
 )
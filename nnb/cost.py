@@ -21,69 +21,171 @@ __all__ = [
     'mean_square_error',
     'MeanSquareError',
     'negative_log_likelihood_error',
-    'NegativeLogLikelihoodError'
+    'NegativeLogLikelihoodError',
+    'softmax_negative_log_likelihood_error',
+    'SoftmaxNegativeLogLikelihoodError'
 ]
 
 import theano.tensor as T
-import theano
 import nnb
 
 
-def _check_inputs(prev):
-    if len(prev) != 2:
-        raise ValueError("Error models can only treat exactly 2 inputs")
+def _error_options():
+    opts = nnb.utils.Options()
+    #If True, a third input holds the weights of the examples instead of a
+    #mask. Four inputs are always outputs, expected outputs, mask and weights.
+    opts.add(
+        name='weighted',
+        value=False,
+        value_type=bool
+    )
+    return opts
 
-def cross_entropy_error(p, y):
+def _error_inputs(model, prev):
+    """The outputs, expected outputs, mask and weights given to an error
+    Model"""
+    if len(prev) not in (2, 3, 4):
+        raise ValueError("Error models can only treat 2 inputs, plus an " +
+                        "optional mask and optional weights")
+    if len(prev) == 3 and model.options.get('weighted'):
+        return [prev[0], prev[1], None, prev[2]]
+    return list(prev) + [None] * (4 - len(prev))
+
+def _single_example(error, mask, weights):
+    if mask is not None or weights is not None:
+        raise ValueError("A mask and weights can only be used with more " +
+                        "than one example")
+    return error
+
+def _reduce(errors, mask=None, weights=None):
+    """Averages the errors of every example.
+    The mask and the weights have the same shape as the errors. Examples
+    where the mask is 0 are left out of the average and the error of each
+    example is multiplied by its weight. Masked examples should still hold
+    valid values, or their NaNs will leak into the gradient.
+    The errors of a single example (0-D predictions, or 1-D for the negative
+    log likelihoods) take no mask or weights: giving them raises a
+    ValueError.
+    """
+    if weights is not None:
+        errors = errors * weights
+    if mask is None:
+        return T.mean(errors)
+    return T.sum(errors * mask) / T.sum(mask)
+
+def cross_entropy_error(p, y, mask=None, weights=None):
+    """Cross entropy between p and y along their last axis. Any other axes
+    are examples, e.g. (time, batch, classes) tensors, and the error is
+    averaged over them. See _reduce for the mask and weights.
+    """
     if p.ndim != y.ndim:
         raise ValueError("Cross entropy can only be performed in outputs and" +
                         " expected outputs with the same dimensions")
     if p.ndim == 0:
-        return -y * T.log(p)
-    elif p.ndim <= 2:
-        return -T.mean((y * T.log(p)).T.sum(axis=0))
-    elif p.ndim == 3:
-        def one_step(i, o):
-            return (o * T.log(i)).T.sum(axis=0)
-        errors, _ = theano.scan(fn=one_step, sequences=[p, y])
-        return -T.mean(errors)
-    else:
-        raise NotImplemented("cross_entropy can only be performed on ndim up " +
-                            "to 3")
+        return _single_example(-y * T.log(p), mask, weights)
+    return _reduce(-(y * T.log(p)).sum(axis=-1), mask, weights)
 
 class CrossEntropyError(nnb.Model):
+    @staticmethod
+    def init_options():
+        return _error_options()
+
     def apply(self, prev):
-        _check_inputs(prev)
-        return [cross_entropy_error(*prev)]
-
-def mean_square_error(p, y):
-    if p.ndim == 0 and y.ndim == 0:
-        return T.sqr(p - y) / 2
-    elif p.ndim == 1 and y.ndim == 1:
-        return T.mean(T.sqr(p - y)) / 2
-    elif p.ndim == 2 and y.ndim == 2:
-        return T.mean(T.sqr(p - y).sum(axis=1)) / 2
-    else:
+        return [cross_entropy_error(*_error_inputs(self, prev))]
+
+def mean_square_error(p, y, mask=None, weights=None):
+    """Half the squared error between p and y. For vectors it is averaged over
+    the elements. For tensors with more dimensions the squares are summed
+    along the last axis and averaged over the other axes. See _reduce for the
+    mask and weights.
+    """
+    if p.ndim != y.ndim:
         error_str = "Invalid dimensions for mean square error: {0} and {1}."
         error_str = error_str.format(p.ndim, y.ndim)
         raise ValueError(error_str)
+    if p.ndim == 0:
+        return _single_example(T.sqr(p - y) / 2, mask, weights)
+    elif p.ndim == 1:
+        errors = T.sqr(p - y)
+    else:
+        errors = T.sqr(p - y).sum(axis=-1)
+    return _reduce(errors, mask, weights) / 2
 
 class MeanSquareError(nnb.Model):
+    @staticmethod
+    def init_options():
+        return _error_options()
+
     def apply(self, prev):
-        _check_inputs(prev)
-        return [mean_square_error(*prev)]
+        return [mean_square_error(*_error_inputs(self, prev))]
 
-def negative_log_likelihood_error(p, y):
+def negative_log_likelihood_error(p, y, mask=None, weights=None):
+    """Negative log likelihood of the classes y, given the probabilities p of
+    every class along the last axis. y has the shape of p without its last
+    axis. Only the probabilities of the expected classes go through the log.
+    See _reduce for the mask and weights.
+    """
     if p.ndim == 1 and y.ndim == 0:
-        return -T.log(p[y])
+        return _single_example(-T.log(p[y]), mask, weights)
     elif p.ndim == 2 and y.ndim == 1:
-        return -T.mean(T.log(p)[T.arange(y.shape[0]), y])
+        errors = -T.log(p[T.arange(y.shape[0]), y])
+    elif p.ndim > 2 and y.ndim == p.ndim - 1:
+        flat_y = y.flatten()
+        flat_p = p.reshape((flat_y.shape[0], p.shape[-1]))
+        errors = -T.log(flat_p[T.arange(flat_y.shape[0]), flat_y])
+        errors = errors.reshape(y.shape, ndim=y.ndim)
     else:
         error_str = "Invalid dimensions for negative log likelihood: {0} and" +\
                     "{1}."
         error_str = error_str.format(p.ndim, y.ndim)
         raise ValueError(error_str)
+    return _reduce(errors, mask, weights)
 
 class NegativeLogLikelihoodError(nnb.Model):
+    @staticmethod
+    def init_options():
+        return _error_options()
+
+    def apply(self, prev):
+        return [negative_log_likelihood_error(*_error_inputs(self, prev))]
+
+def softmax_negative_log_likelihood_error(z, y, mask=None, weights=None):
+    """Negative log likelihood of softmax(z), computed directly from z.
+    This is the same as negative_log_likelihood_error(T.nnet.softmax(z), y),
+    but theano's fused softmax cross entropy op is numerically stable, for
+    the error and its gradient, and avoids computing log(softmax(z))
+    separately. Each row of z is still normalized over all of its entries.
+    Just like negative_log_likelihood_error, z can have any number of
+    leading example axes.
+    """
+    if z.ndim == 0 or y.ndim != z.ndim - 1:
+        error_str = "Invalid dimensions for softmax negative log " +\
+                    "likelihood: {0} and {1}."
+        error_str = error_str.format(z.ndim, y.ndim)
+        raise ValueError(error_str)
+    if z.ndim == 1:
+        error = T.nnet.crossentropy_softmax_1hot(z.dimshuffle('x', 0),
+                                                y.dimshuffle('x'))[0][0]
+        return _single_example(error, mask, weights)
+
+    flat_y = y.flatten()
+    flat_z = z.reshape((flat_y.shape[0], z.shape[-1]))
+    errors = T.nnet.crossentropy_softmax_1hot(flat_z, flat_y)[0]
+    if y.ndim > 1:
+        errors = errors.reshape(y.shape, ndim=y.ndim)
+    return _reduce(errors, mask, weights)
+
+class SoftmaxNegativeLogLikelihoodError(nnb.Model):
+    """Fused softmax and negative log likelihood cost
+    The first input should be the unnormalized scores (logits) of each class,
+    e.g. the output of a PerceptronLayer with nnb.activation.linear. The
+    second input is the index of the expected class. A mask and weights can
+    follow, just like for the other error Models.
+    """
+    @staticmethod
+    def init_options():
+        return _error_options()
+
     def apply(self, prev):
-        _check_inputs(prev)
-        return [negative_log_likelihood_error(*prev)]
+        return [softmax_negative_log_likelihood_error(
+                    *_error_inputs(self, prev))]
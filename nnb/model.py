@@ -19,6 +19,69 @@ import theano
 import theano.tensor as T
 import nnb.utils as utils
 
+_train_mode = False
+
+def is_training():
+    """Tells if the graph being built is meant for training.
+    Models that behave differently during training and inference, like the
+    DropoutLayer, should check this in their apply method. The mode is set by
+    the `train` parameter of Model.get_io. Trainers always build their graphs
+    in training mode, while Model.compile builds inference graphs by default.
+    """
+    return _train_mode
+
+_apply_memo = None
+_apply_hook = None
+
+def _apply(model, prev):
+    out = model.apply(prev)
+    if _apply_hook is not None:
+        _apply_hook(model, prev, out)
+    return out
+
+def _is_stochastic(model):
+    """Tells if a Model or any Model in its options is stochastic"""
+    if model.stochastic:
+        return True
+    for name in model.options.names():
+        value = model.options.get(name)
+        if not isinstance(value, (list, tuple)):
+            value = [value]
+        for v in value:
+            if isinstance(v, Model) and _is_stochastic(v):
+                return True
+    return False
+
+def apply_model(model, prev):
+    """Calls model.apply(prev), reusing the outputs of earlier calls.
+    While Model.get_io builds a graph, the outputs of each (model, inputs)
+    pair are remembered, so a Model shared by several branches builds its
+    subgraph only once. Models that should be applied to other Models'
+    outputs, like the join Models, should call this instead of the children's
+    apply method. Models with the stochastic flag set, and the Models that
+    hold them, like a join with a DropoutLayer, are always applied again,
+    since each application draws new random numbers.
+    If the outputs come with updates, they are only returned by the first
+    call, so they are not added twice to the graph.
+    While a graph is profiled (see nnb.utils.profiling), the outputs of each
+    call are tagged with the Model that built them.
+    """
+    if _apply_memo is None or _is_stochastic(model):
+        return _apply(model, prev)
+
+    if prev is None:
+        key = (id(model), None)
+    else:
+        key = (id(model),) + tuple(id(p) for p in prev)
+    if key in _apply_memo:
+        return list(_apply_memo[key][2])
+
+    out = _apply(model, prev)
+    outputs = out[0] if isinstance(out, tuple) else out
+    #The model and the inputs are kept, so their ids aren't reused
+    _apply_memo[key] = (model, prev, outputs)
+    return out
+
 class Model(object):
     """The Model class.
     Everything that has an input and/or generates an output extends this class.
@@ -35,6 +98,13 @@ class Model(object):
     parameters.
     """
 
+    stochastic = False
+    """Tells if each application of the Model gives different outputs for
+    the same inputs, like the DropoutLayer. The outputs of stochastic Models,
+    and of the Models that hold them, are never reused (see
+    nnb.model.apply_model).
+    """
+
     def __init__(self, **kwargs):
         """The initialization method for Models
         Models shouldn't override this method, as it takes care of validating
@@ -51,10 +121,11 @@ class Model(object):
         self.options.set_from_dict(kwargs)
         self.options.check()
 
-        self.params = self.init_params()
-        if not isinstance(self.params, list):
+        params = self.init_params()
+        if not isinstance(params, list):
             raise ValueError("The init_params method should return a list of" +
                             " theano shared variables.")
+        self.params = params
 
     @staticmethod
     def init_options():
@@ -151,17 +222,28 @@ class Model(object):
         raise NotImplementedError("Couldn't find ways to get the inputs for " +
                                     "{0}.".format(type(self)))
 
-    def get_io(self):
+    def get_io(self, train=False):
         """Method that scans the Model for inputs and computes the outputs.
         This method should not be overriden.
+        :param train: If True, the graph is built in training mode. See
+            nnb.model.is_training. Default is False
         :returns: Tuple of length 3, which the first element is a list of theano
             variables representing the Model's user inputs, the second element
             is a theano variable or a list of theano variables representing the
             Model's outputs and the third element is an updates dict, used for
             the theano function.
         """
+        global _train_mode, _apply_memo
         inputs = self._get_inputs()
-        outputs = self.apply(None)
+        old_mode = _train_mode
+        old_memo = _apply_memo
+        _train_mode = train
+        _apply_memo = {}
+        try:
+            outputs = apply_model(self, None)
+        finally:
+            _train_mode = old_mode
+            _apply_memo = old_memo
         updates = theano.updates.OrderedUpdates()
         if isinstance(outputs, tuple):
             updates = outputs[1]
@@ -170,18 +252,25 @@ class Model(object):
             outputs = outputs[0]
         return (inputs, outputs, updates)
 
-    def compile(self, **kwargs):
+    def compile(self, train=False, **kwargs):
         """Compiles the Model into a function.
         This method should not be overriden.
 
+        :param train: If True, the function is compiled in training mode. See
+            nnb.model.is_training. Default is False
         :param **kwargs: Every key=value parameter will be passed along to the
             `theano.function` compiler.
+        If a cache directory is set in nnb.utils.function_cache, the compiled
+        function is reused by later calls on structurally equal Models.
 
         :returns: A callable object that computes outputs, given inputs, the way
         the Model specifies.
         """
-        i, o, u = self.get_io()
-        return theano.function(inputs=i, outputs=o, updates=u, **kwargs)
+        i, o, u = self.get_io(train=train)
+        return utils.function_cache.function(
+            inputs=i, outputs=o, updates=u,
+            key=('Model.compile', self, train), **kwargs
+        )
 
     def __and__(self, other):
         """Concatenates the Model with another vertically.
@@ -199,7 +288,7 @@ class Model(object):
         :returns: A new Model that will pass it's inputs to this and the other
             model and outputs both Models' outputs.
         """
-        return VerticalJoinModel(m1=self, m2=other)
+        return _join(VerticalJoinModel, self, other)
 
     def __or__(self, other):
         """Concatenates the Model with another horizontally.
@@ -217,7 +306,7 @@ class Model(object):
         :returns: A new Model that will take this Model's outputs and pass them
             on to the other Model inputs.
         """
-        return HorizontalJoinModel(m1=self, m2=other)
+        return _join(HorizontalJoinModel, self, other)
 
     def __getitem__(self, val):
         """Slices this Model's output.
@@ -342,15 +431,66 @@ class InputLayer(Model):
             prev = []
         return [self._inp] + prev
 
+def _children(model, cls):
+    """The Models joined by `model` if it's a `cls` join, else [model]"""
+    if type(model) is cls:
+        return model.options.get('models')
+    return [model]
+
+def _join(cls, left, right):
+    """Joins two Models with a flat `cls` join"""
+    return cls(models=_children(left, cls) + _children(right, cls))
+
+class _JoinParams(object):
+    """The params of a join: its own ones, returned by init_params, and the
+    ones of its Models, without repetitions.
+    They are only gathered on first access, so a chain like m1 | m2 | ... | mN,
+    which builds N joins, takes linear time.
+    """
+
+    def __get__(self, join, cls=None):
+        if join is None:
+            return self
+        if join._params is None:
+            params = list(join._own_params)
+            for model in join.options.get('models'):
+                params += model.params
+            join._params = _uniq_list(params)
+        return join._params
+
+    def __set__(self, join, params):
+        join._own_params = params
+        join._params = None
+
+def _join_inputs(models):
+    inps = []
+    for model in models:
+        try:
+            inps += model._get_inputs()
+        except NotImplementedError:
+            pass
+    return _uniq_list(inps)
+
+def _apply_child(model, prev, updates):
+    out = apply_model(model, prev)
+    if isinstance(out, tuple):
+        updates += out[1]
+        out = out[0]
+
+    if not isinstance(out, list):
+        raise ValueError(("The model {0} didn't return a list of theano" +
+                            " variables.").format(type(model)))
+    return out
+
 class VerticalJoinModel(Model):
-    """Model that joins two Models vertically
-    Joining a Model vertically means that they will both receive the same inputs
+    """Model that joins Models vertically
+    Joining Models vertically means that they will all receive the same inputs
     and their outputs will be concatenated in a single list.
     Example:
 
         m1 = Model1()
         m2 = Model2()
-        vertical = VerticalModel(m1=m1, m2=m2)
+        vertical = VerticalJoinModel(models=[m1, m2])
 
     Now vertical is a Model that can be visualized as:
 
@@ -360,14 +500,17 @@ class VerticalJoinModel(Model):
                          \           /
                            --> m2 --
 
-    :param m1: Required Model. This will be the first Model to be joined
-    :param m2: Required Model. This will be the second Model to be joined
+    Chains like m1 & m2 & m3 build a single flat VerticalJoinModel with the
+    three Models, instead of nesting a join inside another.
+
+    :param models: Required list of Models to be joined
 
     Inputs:
         Any number of inputs of any shape
 
     Outputs:
-        Concatenation of m1 and m2 outputs, when given this Model's inputs.
+        Concatenation of the joined Models' outputs, when given this Model's
+            inputs.
 
     IMPORTANT: This Model is never instantiated directly. The Model '&' notation
                 creates a VerticalJoinModel
@@ -377,88 +520,58 @@ class VerticalJoinModel(Model):
     def init_options():
         opts = utils.Options()
         opts.add(
-            name="m1",
-            required=True
-        )
-        opts.add(
-            name="m2",
-            required=True
+            name="models",
+            required=True,
+            value_type=list
         )
 
         return opts
 
+    params = _JoinParams()
+
     def init_params(self):
-        m1 = self.options.get('m1')
-        m2 = self.options.get('m2')
-        return _uniq_list(m1.params + m2.params)
+        #The params of the Models are gathered by _JoinParams
+        return []
 
     def _get_inputs(self):
-        m1 = self.options.get('m1')
-        m2 = self.options.get('m2')
-        inp1 = []
-        try:
-            inp1 = m1._get_inputs()
-        except NotImplementedError:
-            pass
-        inp2 = []
-        try:
-            inp2 = m2._get_inputs()
-        except NotImplementedError:
-            pass
-
-        inps = _uniq_list(inp1 + inp2)
-
-        return inps
+        return _join_inputs(self.options.get('models'))
 
     def apply(self, prev):
-        m1 = self.options.get('m1')
-        m2 = self.options.get('m2')
-        out1 = m1.apply(prev)
         updates = theano.updates.OrderedUpdates()
+        outs = []
+        for model in self.options.get('models'):
+            outs += _apply_child(model, prev, updates)
 
-        if isinstance(out1, tuple):
-            updates += out1[1]
-            out1 = out1[0]
-
-        if not isinstance(out1, list):
-            raise ValueError(("The model {0} didn't return a list of theano" +
-                                " variables.").format(type(m1)))
-        out2 = m2.apply(prev)
-
-        if isinstance(out2, tuple):
-            updates += out2[1]
-            out2 = out2[0]
-
-        if not isinstance(out2, list):
-            raise ValueError(("The model {0} didn't return a list of theano" +
-                                " variables.").format(type(m2)))
         if len(updates) == 0:
-            return out1 + out2 #lists
+            return outs
         else:
-            return out1 + out2, updates
+            return outs, updates
 
 class HorizontalJoinModel(Model):
-    """Model that joins two Models horizontally
-    Joining a Model horizontally means that the output of the first Model will
-    be used as input of the second Model.
+    """Model that joins Models horizontally
+    Joining Models horizontally means that the output of each Model will be
+    used as input of the next one.
     Example:
 
         m1 = Model1()
         m2 = Model2()
-        horizontal = HorizontalModel(m1=m1, m2=m2)
+        horizontal = HorizontalJoinModel(models=[m1, m2])
 
     Now horizontal is a Model that can be visualized as:
 
         m1 --> m2
 
-    :param m1: Required Model. This will be the first Model to be joined
-    :param m2: Required Model. This will be the second Model to be joined
+    Chains like m1 | m2 | m3 build a single flat HorizontalJoinModel with the
+    three Models, which are applied one after the other without recursion.
+
+    :param models: Required list of Models to be joined
 
     Inputs:
         Any number of inputs of any shape
 
     Outputs:
-        m2's outputs, when given m1's outputs, when given this Model's inputs
+        The last Model's outputs, when given the previous Model's outputs, and
+            so on, down to the first Model, which is given this Model's inputs
 
     IMPORTANT: This Model is never instantiated directly. The Model '|' notation
                 creates a HorizontalJoinModel
@@ -468,63 +581,32 @@ class HorizontalJoinModel(Model):
     def init_options():
         opts = utils.Options()
         opts.add(
-            name="m1",
-            required=True
-        )
-        opts.add(
-            name="m2",
-            required=True
+            name="models",
+            required=True,
+            value_type=list
         )
 
         return opts
 
+    params = _JoinParams()
+
     def init_params(self):
-        m1 = self.options.get('m1')
-        m2 = self.options.get('m2')
-        return _uniq_list(m1.params + m2.params)
+        #The params of the Models are gathered by _JoinParams
+        return []
 
     def _get_inputs(self):
-        m1 = self.options.get('m1')
-        m2 = self.options.get('m2')
-        inp1 = []
-        try:
-            inp1 = m1._get_inputs()
-        except NotImplementedError:
-            pass
-        inp2 = []
-        try:
-            inp2 = m2._get_inputs()
-        except NotImplementedError:
-            pass
-
-        inps = _uniq_list(inp1 + inp2)
-
-        return inps
+        return _join_inputs(self.options.get('models'))
 
     def apply(self, prev):
-        m1 = self.options.get('m1')
-        m2 = self.options.get('m2')
         updates = theano.updates.OrderedUpdates()
-        out1 = m1.apply(prev)
-        if isinstance(out1, tuple):
-            updates += out1[1]
-            out1 = out1[0]
-
-        if not isinstance(out1, list):
-            raise ValueError(("The model {0} didn't return a list of theano" +
-                                " variables.").format(type(m1)))
-        out2 = m2.apply(out1)
-        if isinstance(out2, tuple):
-            updates += out2[1]
-            out2 = out2[0]
-
-        if not isinstance(out2, list):
-            raise ValueError(("The model {0} didn't return a list of theano" +
-                                " variables.").format(type(m2)))
+        out = prev
+        for model in self.options.get('models'):
+            out = _apply_child(model, out, updates)
+
         if len(updates) == 0:
-            return out2
+            return out
         else:
-            return out2, updates
+            return out, updates
 
 class Picker(Model):
     """Model that uses its input to slice a set of choices
@@ -132,6 +132,9 @@ class SoftmaxLayer(Model):
     """A Softmax layer
     This Model is very similar to the PerceptronLayer Model. The only big
     difference is that the activation_func is set to a softmax function.
+    If this layer is only followed by a negative log likelihood cost, it is
+    faster and more stable to train a PerceptronLayer with
+    nnb.activation.linear followed by nnb.cost.SoftmaxNegativeLogLikelihoodError
 
     :param insize: Required int. The input size. If the input of this model is
         a vector, insize will be the vector's length. If the input is a matrix,
@@ -224,6 +227,326 @@ class SoftmaxLayer(Model):
         return [T.nnet.softmax(T.dot(inps, W_softmax) + b_softmax)]
 
 
+class HierarchicalSoftmaxLayer(Model):
+    """A class-based hierarchical softmax layer
+    This Model factors the softmax over a large number of outputs in two
+    softmaxes: one that predicts the class of the output and one that predicts
+    the output among the members of that class. With about sqrt(outsize)
+    classes of about sqrt(outsize) members each, the cost of an example grows
+    with sqrt(outsize) instead of outsize.
+    The classes can be built from word frequencies with
+    nnb.utils.WordVecsHelper.frequency_classes.
+
+    :param insize: Required int. The input size.
+    :param classes: Required numpy ndarray of ints with ndim=1. classes[i] is
+        the class of the output i. The number of outputs is len(classes) and
+        the classes should be numbered from 0 to the number of classes - 1.
+    :param init: The weight initializer for the layer weights. Default is
+        XavierInitializer.
+    :param W_class: Optional numpy ndarray of shape (insize, number of classes)
+        with the weights of the class softmax.
+    :param b_class: Optional numpy ndarray with the bias of the class softmax.
+    :param W_words: Optional numpy ndarray of shape (number of outputs, insize)
+        with the weights of the outputs. Notice each row is an output.
+    :param b_words: Optional numpy ndarray with the bias of the outputs.
+
+    Inputs:
+        A matrix x, where each row is a vector of size insize, and an int
+            vector y with the expected output of each row of x. Alternatively,
+            only the matrix x.
+
+    Outputs:
+        If y is given, the negative log likelihood of y, averaged over the rows
+            of x. This can be used as a cost both for training and evaluation.
+            If only x is given, a matrix with the probabilities of every output
+            for each row of x. This computes every output and is meant for
+            evaluation only.
+
+    Tunable Parameters:
+        W_class - Weight matrix of the class softmax
+        b_class - Bias vector of the class softmax
+        W_words - Weight matrix of the outputs
+        b_words - Bias vector of the outputs
+    """
+
+    @staticmethod
+    def init_options():
+        ops = utils.Options()
+        ops.add(
+            name="insize",
+            required=True,
+            value_type=int
+        )
+        ops.add(
+            name="classes",
+            required=True,
+            value_type=np.ndarray
+        )
+        ops.add(
+            name="init",
+            value_type=init.Initializer,
+            value=init.XavierInitializer()
+        )
+        ops.add(
+            name="W_class",
+            value_type=np.ndarray
+        )
+        ops.add(
+            name="b_class",
+            value_type=np.ndarray
+        )
+        ops.add(
+            name="W_words",
+            value_type=np.ndarray
+        )
+        ops.add(
+            name="b_words",
+            value_type=np.ndarray
+        )
+        return ops
+
+    def init_params(self):
+        options = self.options
+        insize = options.get('insize')
+        init = options.get('init')
+        classes = np.asarray(options.get('classes'), dtype='int64')
+        outsize = len(classes)
+        classes_nr = classes.max() + 1
+
+        #Outputs sorted by class, so each class is a contiguous range of order
+        order = np.argsort(classes, kind='mergesort')
+        class_size = np.bincount(classes, minlength=classes_nr)
+        class_start = np.cumsum(class_size) - class_size
+        word_pos = np.empty(outsize, dtype='int64')
+        word_pos[order] = np.arange(outsize) - class_start[classes[order]]
+
+        #The index arrays are as large as the vocabulary, so they are kept in
+        #shared variables, not as constants of every compiled graph
+        def make_index(name, value):
+            return theano.shared(np.asarray(value, dtype='int32'), name=name)
+
+        self._classes = make_index('classes', classes)
+        self._order = make_index('order', order)
+        self._class_start = make_index('class_start', class_start)
+        self._class_size = make_index('class_size', class_size)
+        self._word_pos = make_index('word_pos', word_pos)
+        self._classes_nr = int(classes_nr)
+        self._width = int(class_size.max())
+
+        def make_shared(name, value, shape):
+            if value is None:
+                if len(shape) == 1:
+                    value = np.zeros(shape, dtype=theano.config.floatX)
+                else:
+                    value = init(shape)
+            return theano.shared(value=value, name=name, borrow=True)
+
+        return [
+            make_shared('W_class', options.get('W_class'),
+                        (insize, classes_nr)),
+            make_shared('b_class', options.get('b_class'), (classes_nr,)),
+            make_shared('W_words', options.get('W_words'), (outsize, insize)),
+            make_shared('b_words', options.get('b_words'), (outsize,))
+        ]
+
+    def apply(self, prev):
+        W_class, b_class, W_words, b_words = self.params
+        x = prev[0]
+        class_logits = T.dot(x, W_class) + b_class
+
+        if len(prev) == 1:
+            return [self._probabilities(x, class_logits)]
+
+        y = prev[1]
+        c = self._classes[y]
+        class_nll = T.nnet.crossentropy_softmax_1hot(class_logits, c)[0]
+
+        #Gather the members of each example's class, padded to the size of the
+        #largest class by repeating the last member
+        width = self._width
+        start = self._class_start[c]
+        size = self._class_size[c]
+        pos = T.arange(width).dimshuffle('x', 0)
+        idx = T.minimum(start.dimshuffle(0, 'x') + pos,
+                        (start + size - 1).dimshuffle(0, 'x'))
+        members = self._order[idx.flatten()]
+
+        W = W_words[members].reshape((x.shape[0], width, x.shape[1]))
+        logits = (W * x.dimshuffle(0, 'x', 1)).sum(axis=2)
+        logits += b_words[members].reshape((x.shape[0], width))
+        neg_inf = np.asarray(-np.inf, dtype=logits.dtype)
+        logits = T.switch(T.lt(pos, size.dimshuffle(0, 'x')), logits, neg_inf)
+
+        word_pos = self._word_pos[y]
+        word_nll = T.nnet.crossentropy_softmax_1hot(logits, word_pos)[0]
+
+        return [T.mean(class_nll + word_nll)]
+
+    def _probabilities(self, x, class_logits):
+        W_class, b_class, W_words, b_words = self.params
+        classes_nr = self._classes_nr
+        width = self._width
+
+        #Every class padded to the same width, so the softmax of each class
+        #is computed along the last axis of a (rows, classes, width) tensor
+        pos = T.arange(width).dimshuffle('x', 0)
+        class_size = self._class_size.dimshuffle(0, 'x')
+        padded = self._class_start.dimshuffle(0, 'x') + \
+                    T.minimum(pos, class_size - 1)
+        padded = self._order[padded]
+
+        logits = T.dot(x, W_words.T) + b_words
+        logits = T.take(logits, padded.flatten(), axis=1)
+        logits = logits.reshape((x.shape[0], classes_nr, width))
+        neg_inf = np.asarray(-np.inf, dtype=logits.dtype)
+        valid = T.lt(pos, class_size).dimshuffle('x', 0, 1)
+        logits = T.switch(valid, logits, neg_inf)
+        m = T.max(logits, axis=2, keepdims=True)
+        log_p = logits - m - T.log(T.sum(T.exp(logits - m), axis=2,
+                                            keepdims=True))
+        log_p = log_p.reshape((x.shape[0], classes_nr * width))
+        log_p = T.take(log_p, self._classes * width + self._word_pos, axis=1)
+
+        log_p_class = T.log(T.nnet.softmax(class_logits))
+        return T.exp(log_p + T.take(log_p_class, self._classes, axis=1))
+
+
+class SampledSoftmaxLayer(SoftmaxLayer):
+    """A softmax layer trained with sampled softmax
+    This Model holds the same parameters as a SoftmaxLayer, but when its graph
+    is built in training mode (see nnb.model.is_training) the cost is computed
+    over the expected output and `samples` outputs drawn from a proposal
+    distribution, instead of over every output. The logits are corrected by
+    the log probability of the proposal, so the gradients are an estimate of
+    the full softmax gradients. The cost of an example grows with the number
+    of samples instead of outsize.
+    In inference mode the exact softmax is computed, so the same Model can be
+    used for validation.
+
+    :param insize: Required int. The input size.
+    :param outsize: Required int. The number of outputs.
+    :param samples: Required int. The number of outputs sampled for each
+        training batch. The samples are shared by every row of the batch.
+    :param proposal: Optional numpy ndarray with ndim=1. The probability of
+        sampling each output. A good choice for words is their unigram
+        distribution, see nnb.utils.WordVecsHelper.unigram_distribution.
+        Default is the uniform distribution.
+    :param table_size: Optional int. Samples from the proposal are drawn with
+        a table of this size, like word2vec does. Default is 1e6.
+    :param init: The weight initializer for the layer weights. Default is
+        XavierInitializer.
+    :param W_softmax: Optional numpy ndarray with ndim=2, just like in the
+        SoftmaxLayer.
+    :param b_softmax: Optional numpy ndarray with ndim=1, just like in the
+        SoftmaxLayer.
+
+    Inputs:
+        A matrix x, where each row is a vector of size insize, and an int
+            vector y with the expected output of each row of x. Alternatively,
+            only the matrix x.
+
+    Outputs:
+        If y is given, the negative log likelihood of y averaged over the rows
+            of x, estimated with sampled softmax in training mode and exact in
+            inference mode. If only x is given, the softmax over every output.
+
+    Tunable Parameters:
+        W_softmax - Weight matrix
+        b_softmax - Bias vector
+    """
+    stochastic = True
+
+    @staticmethod
+    def init_options():
+        ops = SoftmaxLayer.init_options()
+        ops.add(
+            name="samples",
+            required=True,
+            value_type=int
+        )
+        ops.add(
+            name="proposal",
+            value_type=np.ndarray
+        )
+        ops.add(
+            name="table_size",
+            value=1000000,
+            value_type=int
+        )
+        return ops
+
+    def init_params(self):
+        outsize = self.options.get('outsize')
+        samples = self.options.get('samples')
+        proposal = self.options.get('proposal')
+        table_size = self.options.get('table_size')
+
+        if proposal is None:
+            proposal = np.ones(outsize)
+            self._table = None
+        else:
+            #word2vec-like table, so drawing a sample is a single lookup.
+            #It is kept in a shared variable, not as a constant of every
+            #compiled graph.
+            cdf = np.cumsum(proposal / float(proposal.sum()))
+            table = np.searchsorted(cdf, (np.arange(table_size) + 0.5) /
+                                        table_size)
+            table = np.minimum(table, outsize - 1).astype('int32')
+            self._table = theano.shared(table, name='sampling_table')
+
+        q = np.maximum(proposal / float(proposal.sum()), 1e-12)
+        self._log_q = theano.shared(
+            np.asarray(np.log(q * samples), dtype=theano.config.floatX),
+            name='log_q'
+        )
+        self._srng = theano.tensor.shared_randomstreams.RandomStreams(
+            nnb.rng.randint(999999))
+
+        return super(SampledSoftmaxLayer, self).init_params()
+
+    def _sample(self):
+        samples = self.options.get('samples')
+        u = self._srng.uniform(size=(samples,))
+        if self._table is None:
+            size = self.options.get('outsize')
+        else:
+            size = self.options.get('table_size')
+        i = T.minimum(T.cast(T.floor(u * size), 'int64'), size - 1)
+        if self._table is None:
+            return i
+        return self._table[i]
+
+    def apply(self, prev):
+        W_softmax, b_softmax = self.params
+        x = prev[0]
+
+        if len(prev) == 1:
+            return [T.nnet.softmax(T.dot(x, W_softmax) + b_softmax)]
+
+        y = prev[1]
+        if not nnb.model.is_training():
+            logits = T.dot(x, W_softmax) + b_softmax
+            return [T.mean(T.nnet.crossentropy_softmax_1hot(logits, y)[0])]
+
+        log_q = self._log_q
+        samples = self._sample()
+
+        W_y = W_softmax.T[y]
+        true_logits = (x * W_y).sum(axis=1) + b_softmax[y] - log_q[y]
+        W_s = W_softmax.T[samples]
+        sampled_logits = T.dot(x, W_s.T) + b_softmax[samples] - log_q[samples]
+
+        #A sample that is the expected output is not a negative example
+        hits = T.eq(y.dimshuffle(0, 'x'), samples.dimshuffle('x', 0))
+        neg_inf = np.asarray(-np.inf, dtype=sampled_logits.dtype)
+        sampled_logits = T.switch(hits, neg_inf, sampled_logits)
+
+        logits = T.concatenate([true_logits.dimshuffle(0, 'x'),
+                                sampled_logits], axis=1)
+        targets = T.zeros_like(y)
+        return [T.mean(T.nnet.crossentropy_softmax_1hot(logits, targets)[0])]
+
+
 class RecursiveNeuralNetwork(Model):
     """A Recursive Neural Network.
     Each composition in the recursive NN is made with the model passed by
@@ -348,7 +671,7 @@ class RecursiveNeuralNetwork(Model):
             for partial in partials:
                 inputs1.append(partial[children[0]])
                 inputs2.append(partial[children[1]])
-            model_out = comp_model.apply(inputs1 + inputs2)
+            model_out = nnb.model.apply_model(comp_model, inputs1 + inputs2)
             updates = theano.updates.OrderedUpdates()
             if isinstance(model_out, tuple):
                 updates += model_out[1]
@@ -868,7 +1191,7 @@ class RecurrentNeuralNetwork(Model):
         h0 = self.params[:len(self.params) - len(model.params)]
 
         def one_step(*args):
-            return model.apply(list(args))
+            return nnb.model.apply_model(model, list(args))
 
         h, updates = theano.scan(
             fn=one_step,
@@ -1000,6 +1323,202 @@ class ConvolutionalLayer(Model):
 
         return [output.dimshuffle(1, 2, 3).flatten(ndim=2).dimshuffle(1, 0)]
 
+class ConvolutionalBank(Model):
+    """A bank of convolutional layers with different window sizes
+    This Model computes the same outputs as several ConvolutionalLayers with
+    different window sizes applied to the same input, but it does so with a
+    single convolution. The filters of every window are zero-padded to the
+    largest window and packed together, so the whole bank is computed with one
+    call to theano's conv2d and one activation. The result is then split back
+    into one output per window.
+    This is the way to implement the convolution neural network described in
+    http://emnlp2014.org/papers/pdf/EMNLP2014181.pdf
+
+    :param windows: The list of window sizes. This is a required parameter
+    :param insize: The size of each word vector. This is a required parameter
+    :param outsize: The number of filters for each window. This can be an int,
+        in which case every window has the same number of filters, or a list
+        with one int per window. This is a required parameter
+    :param stride: The 'step size' when performing each filter. The default
+        value for this parameter is 1
+    :param activation_func: The activation function to be used. The default
+        value for this parameter is nnb.activation.sigmoid
+    :param pool: If set to True, a max-over-time pooling is applied to the
+        output of each window, so each output is a vector of size 'outsize'.
+        The default value for this parameter is False
+    :param W: Optional list of weight tensors, one per window. Each tensor has
+        the same shape as the W parameter of a ConvolutionalLayer with that
+        window. If not specified the tensors will be initialized randomly
+    :param b: Optional list of bias vectors, one per window. If not specified
+        the vectors will be initialized with zeros
+    :param init: The Initializer used to initialize the weights. The default
+        initializer is a XavierInitializer.
+
+    Inputs:
+        A matrix, where each line is a word vector of size 'insize'. The
+            matrix should have at least as many lines as the largest window
+
+    Outputs:
+        One output per window, in the same order as the 'windows' parameter.
+            Each output is the same matrix a ConvolutionalLayer with that window
+            would output. If 'pool' is set, each output is the max over the
+            lines of that matrix instead. To get a single feature vector, put a
+            ConcatenationModel after this Model
+
+    Tunable Parameters:
+        W_i - Tensor of weights for the i-th window, for every window
+        b_i - Bias vector for the i-th window, for every window
+    """
+    @staticmethod
+    def init_options():
+        opts = utils.Options()
+        opts.add(
+            name='windows',
+            value_type=list,
+            required=True
+        )
+        opts.add(
+            name='insize',
+            value_type=int,
+            required=True
+        )
+        opts.add(
+            name='outsize',
+            value_type=[int, list],
+            required=True
+        )
+        opts.add(
+            name='stride',
+            value_type=int,
+            value=1
+        )
+        opts.add(
+            name='activation_func',
+            value=nnb.activation.sigmoid
+        )
+        opts.add(
+            name='pool',
+            value_type=bool,
+            value=False
+        )
+        opts.add(
+            name='W',
+            value_type=list
+        )
+        opts.add(
+            name='b',
+            value_type=list
+        )
+        opts.add(
+            name='init',
+            value_type=init.Initializer,
+            value=init.XavierInitializer()
+        )
+
+        return opts
+
+    def _get_outsizes(self):
+        windows = self.options.get('windows')
+        outsize = self.options.get('outsize')
+        if isinstance(outsize, int):
+            return [outsize] * len(windows)
+        return outsize
+
+    def init_params(self):
+        opts = self.options
+        windows = opts.get('windows')
+        insize = opts.get('insize')
+        init = opts.get('init')
+        outsizes = self._get_outsizes()
+        Ws = opts.get('W')
+        bs = opts.get('b')
+
+        if len(windows) == 0:
+            raise ValueError("The 'windows' option should have at least one " +
+                            "window size.")
+        if len(outsizes) != len(windows):
+            raise ValueError("The 'outsize' option should have one number of " +
+                            "filters per window.")
+        if Ws is None:
+            Ws = [None] * len(windows)
+        if bs is None:
+            bs = [None] * len(windows)
+        if len(Ws) != len(windows) or len(bs) != len(windows):
+            raise ValueError("The 'W' and 'b' options should have one value " +
+                            "per window.")
+
+        W_params = []
+        b_params = []
+        for i, (window, outsize) in enumerate(zip(windows, outsizes)):
+            W = Ws[i]
+            if W is None:
+                W = init((outsize, insize, window))
+            W_params.append(
+                theano.shared(value=W, name='W_{0}'.format(i), borrow=True))
+
+            b = bs[i]
+            if b is None:
+                b = np.zeros(outsize, dtype=theano.config.floatX)
+            b_params.append(
+                theano.shared(value=b, name='b_{0}'.format(i), borrow=True))
+
+        return W_params + b_params
+
+    def apply(self, prev):
+        windows = self.options.get('windows')
+        insize = self.options.get('insize')
+        stride = self.options.get('stride')
+        act = self.options.get('activation_func')
+        pool = self.options.get('pool')
+        outsizes = self._get_outsizes()
+        W_params = self.params[:len(windows)]
+        b_params = self.params[len(windows):]
+        max_window = max(windows)
+        min_window = min(windows)
+
+        #conv2d flips the filters, so the padding goes on the left. This way
+        #every padded filter starts its window at the same position as the
+        #unpadded one would.
+        filters = []
+        for W, window, outsize in zip(W_params, windows, outsizes):
+            if window < max_window:
+                pad = T.zeros((outsize, insize, max_window - window),
+                                dtype=W.dtype)
+                W = T.concatenate([pad, W], axis=2)
+            filters.append(W)
+        W = T.concatenate(filters, axis=0)
+        b = T.concatenate(b_params, axis=0)
+
+        #The input is padded with zeros so the smallest window still sees every
+        #position. The outputs that read the padding are sliced away below.
+        x = prev[0]
+        if max_window > min_window:
+            x_pad = T.zeros((max_window - min_window, x.shape[1]), dtype=x.dtype)
+            x = T.concatenate([x, x_pad], axis=0)
+
+        conv = T.nnet.conv2d(
+            x.dimshuffle('x', 'x', 1, 0),
+            W.dimshuffle(0, 'x', 1, 2),
+            filter_shape=(sum(outsizes), 1, insize, max_window),
+            image_shape=(1, 1, insize, None),
+            subsample=(1, stride)
+        )
+        output = act(conv + b.dimshuffle('x', 0, 'x', 'x'))
+        output = output.dimshuffle(1, 2, 3).flatten(ndim=2).dimshuffle(1, 0)
+
+        length = prev[0].shape[0]
+        outputs = []
+        start = 0
+        for window, outsize in zip(windows, outsizes):
+            steps = (length - window) // stride + 1
+            o = output[:steps, start:start + outsize]
+            if pool:
+                o = T.max(o, axis=0)
+            outputs.append(o)
+            start += outsize
+
+        return outputs
+
 class MaxPoolingLayer(Model):
     """A max pooling layer
     This layer performs a max pooling layer over a matrix of word vectors. This
@@ -1017,11 +1536,11 @@ class MaxPoolingLayer(Model):
         some performance boost.
 
     Inputs:
-        A matrix
+        A matrix, or a 3DTensor of shape (batch, time, dim)
 
     Outputs:
-        A matrix. Each row is the vector obtained by the max pooling over a
-            window.
+        A tensor like the input. Each row is the vector obtained by the max
+            pooling over a window.
     """
     @staticmethod
     def init_options():
@@ -1042,39 +1561,27 @@ class MaxPoolingLayer(Model):
         window = self.options.get('window')
         ignore_border = self.options.get('ignore_border')
 
-        x = prev[0]
-
-        rest = x.shape[0] % window
-
-        if ignore_border:
-            x = x[:-rest]
-        else:
-            pad = T.alloc(float('-inf'), window - rest, x.shape[1])
-            x = T.concatenate([x, pad], axis=0)
-
-        x = x.reshape((x.shape[0] // window, window, x.shape[1]))
-        return [T.max(x, axis=1)]
+        return [nnb.pooling.max_pooling(prev[0], window, ignore_border)]
 
 class DropoutLayer(PerceptronLayer):
     """Dropout layer
     This Model functions exactly like the Perceptron layer. All the differences
     are listed here. For the whole functionality, read the nnb.PerceptronLayer
     documentation.
-    This Model drops the output from a neuron with probability `p`. Dropping a
-    neuron is equivalent to setting an output to 0.
-    To evaluate a Model using this layer, create another Model that substitutes
-    this layer with a PerceptronLayer and do the following:
-
-    perceptron_layer.params = [param / 2 for param in dropout_layer.params]
-
-    Now the Model containing this perceptron_layer SHOULD NOT be trained. The
-    attempt to do so will result in a difficult to understand theano error.
-    Maybe in the future the action to create an evaluation Model from one that
-    contains a DropoutLayer will be automatic.
+    When the graph is built in training mode (see nnb.model.is_training), this
+    Model drops the output from a neuron with probability `p`. Dropping a
+    neuron is equivalent to setting an output to 0. The outputs that are kept
+    are scaled by 1 / (1 - p), so their expected value doesn't change.
+    Because of this scaling, in inference mode this Model is just a
+    PerceptronLayer with the same parameters, and no random numbers are drawn.
+    There is no need to build a separate Model to evaluate: Trainers build
+    their graphs in training mode, while model.compile() builds an inference
+    function that shares the same parameters.
 
     :param p: The probability of dropping a neuron. This should be a float. The
         default value is 0.5
     """
+    stochastic = True
 
     @staticmethod
     def init_options():
@@ -1086,12 +1593,19 @@ class DropoutLayer(PerceptronLayer):
         )
         return opts
 
+    def init_params(self):
+        self._srng = theano.tensor.shared_randomstreams.RandomStreams(
+            nnb.rng.randint(999999))
+        return super(DropoutLayer, self).init_params()
+
     def apply(self, prev):
-        #Based on https://github.com/mdenil/dropout/blob/master/mlp.py
         o = super(DropoutLayer, self).apply(prev)
+        if not nnb.model.is_training():
+            return o
+
+        #Based on https://github.com/mdenil/dropout/blob/master/mlp.py
         p = self.options.get('p')
-        srng = theano.tensor.shared_randomstreams.RandomStreams(
-            nnb.rng.randint(999999))
-        mask = srng.binomial(n=1, p=(1 - p), size=o[0].shape)
+        mask = self._srng.binomial(n=1, p=(1 - p), size=o[0].shape)
+        mask = T.cast(mask, theano.config.floatX) / (1 - p)
 
-        return [o[0] * T.cast(mask, theano.config.floatX)]
+        return [o[0] * mask]
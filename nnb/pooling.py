@@ -0,0 +1,202 @@
+# NNBlocks is a Deep Learning framework for computational linguistics.
+#
+#   Copyright (C) 2015 Frederico Tommasi Caroli
+#
+#   NNBlocks is free software: you can redistribute it and/or modify it under
+#   the terms of the GNU General Public License as published by the Free
+#   Software Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   NNBlocks is distributed in the hope that it will be useful, but WITHOUT ANY
+#   WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+#   FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+#   details.
+#
+#   You should have received a copy of the GNU General Public License along with
+#   NNBlocks. If not, see http://www.gnu.org/licenses/.
+
+"""Pooling operations over sequences of vectors.
+Every function here pools over the time axis of its input. The input can be a
+matrix of shape (time, dim) or a batch of them with shape (batch, time, dim).
+No function here pads its input: windows are taken with reshapes, slices and
+index arithmetic, and variable length sequences are handled with masks.
+"""
+
+__all__ = [
+    'max_pooling',
+    'max_over_time',
+    'MaxOverTimePoolingLayer',
+    'k_max_pooling',
+    'KMaxPoolingLayer',
+    'dynamic_pooling',
+    'DynamicPoolingLayer'
+]
+
+import numpy as np
+import theano.tensor as T
+import nnb
+import nnb.utils as utils
+
+
+def _check_inputs(prev):
+    if len(prev) not in (1, 2):
+        raise ValueError("Pooling models take a tensor and, optionally, a " +
+                        "mask as inputs")
+
+def _time_axis(x):
+    if x.ndim not in (2, 3):
+        raise ValueError("Pooling can only be performed on tensors of shape " +
+                        "(time, dim) or (batch, time, dim). Got ndim={0}."
+                        .format(x.ndim))
+    return x.ndim - 2
+
+def _time_slice(x, start=None, stop=None):
+    return x[(slice(None),) * _time_axis(x) + (slice(start, stop),)]
+
+def _mask_scores(x, mask):
+    if mask is None:
+        return x
+    neg_inf = np.asarray(-np.inf, dtype=x.dtype)
+    mask = mask.dimshuffle(range(mask.ndim) + ['x'])
+    return T.switch(mask, x, neg_inf)
+
+def max_pooling(x, window, ignore_border=False):
+    """Max over consecutive windows of `window` rows.
+    If ignore_border is False and the number of rows is not a multiple of
+    `window`, the last window is made of the remaining rows.
+    """
+    axis = _time_axis(x)
+    length = x.shape[axis]
+    lead = [x.shape[i] for i in range(axis)]
+
+    if ignore_border:
+        n = length // window
+        full = _time_slice(x, stop=n * window)
+        full = full.reshape(lead + [n, window, x.shape[-1]])
+        return T.max(full, axis=axis + 1)
+
+    n = (length + window - 1) // window
+    start = (n - 1) * window
+    full = _time_slice(x, stop=start)
+    full = full.reshape(lead + [n - 1, window, x.shape[-1]])
+    last = T.max(_time_slice(x, start=start), axis=axis, keepdims=True)
+    return T.concatenate([T.max(full, axis=axis + 1), last], axis=axis)
+
+def max_over_time(x, mask=None):
+    """Max over all the rows of a sequence.
+    :param mask: Optional tensor with the shape of x without its last
+        dimension. Rows where the mask is 0 are ignored.
+    """
+    axis = _time_axis(x)
+    return T.max(_mask_scores(x, mask), axis=axis)
+
+class MaxOverTimePoolingLayer(nnb.Model):
+    """Max over time pooling
+    Inputs:
+        A tensor x of shape (time, dim) or (batch, time, dim) and, optionally,
+            a mask of shape (time,) or (batch, time)
+
+    Outputs:
+        A tensor with the time axis of x removed
+    """
+    def apply(self, prev):
+        _check_inputs(prev)
+        return [max_over_time(*prev)]
+
+def k_max_pooling(x, k, mask=None):
+    """Keeps the k largest rows of each dimension in their original order.
+    :param mask: Optional tensor with the shape of x without its last
+        dimension. Rows where the mask is 0 are never picked, as long as every
+        sequence has at least k unmasked rows.
+    """
+    axis = _time_axis(x)
+    idx = T.argsort(_mask_scores(x, mask), axis=axis)
+    idx = T.sort(_time_slice(idx, start=-k), axis=axis)
+
+    #Gather through the flattened tensor, so the gradient is a single
+    #AdvancedIncSubtensor1
+    dim = x.shape[-1]
+    if axis == 0:
+        flat_idx = idx * dim + T.arange(dim).dimshuffle('x', 0)
+    else:
+        batch = T.arange(x.shape[0]).dimshuffle(0, 'x', 'x')
+        flat_idx = (batch * x.shape[1] + idx) * dim + \
+                    T.arange(dim).dimshuffle('x', 'x', 0)
+    picked = x.flatten()[flat_idx.flatten()]
+    return picked.reshape(flat_idx.shape, ndim=x.ndim)
+
+class KMaxPoolingLayer(nnb.Model):
+    """k-max pooling
+    Picks the k largest values of each dimension over time, preserving the
+    order in which they appear in the sequence.
+
+    :param k: Required int. The number of rows to keep.
+
+    Inputs:
+        A tensor x of shape (time, dim) or (batch, time, dim) and, optionally,
+            a mask of shape (time,) or (batch, time)
+
+    Outputs:
+        A tensor like x with k rows in the time axis
+    """
+    @staticmethod
+    def init_options():
+        opts = utils.Options()
+        opts.add(
+            name='k',
+            value_type=int,
+            required=True
+        )
+        return opts
+
+    def apply(self, prev):
+        _check_inputs(prev)
+        return [k_max_pooling(prev[0], self.options.get('k'), *prev[1:])]
+
+def dynamic_pooling(x, rows):
+    """Max pooling into a fixed number of rows.
+    The sequence is split into `rows` regions of about the same length and the
+    max of each region is taken. Regions overlap when the length isn't a
+    multiple of `rows`, and rows are repeated when the sequence is shorter than
+    `rows`.
+    """
+    axis = _time_axis(x)
+    length = x.shape[axis]
+    i = T.arange(rows)
+    starts = (i * length) // rows
+    ends = ((i + 1) * length + rows - 1) // rows
+    width = T.max(ends - starts)
+
+    #Index matrix of shape (rows, width). Regions narrower than width repeat
+    #their last row, which doesn't change the max.
+    idx = starts.dimshuffle(0, 'x') + T.arange(width).dimshuffle('x', 0)
+    idx = T.minimum(idx, (ends - 1).dimshuffle(0, 'x'))
+
+    return T.max(T.take(x, idx, axis=axis), axis=axis + 1)
+
+class DynamicPoolingLayer(nnb.Model):
+    """Dynamic pooling
+    Pools a sequence of any length into a fixed number of rows.
+
+    :param rows: Required int. The number of output rows.
+
+    Inputs:
+        A tensor x of shape (time, dim) or (batch, time, dim)
+
+    Outputs:
+        A tensor like x with `rows` rows in the time axis
+    """
+    @staticmethod
+    def init_options():
+        opts = utils.Options()
+        opts.add(
+            name='rows',
+            value_type=int,
+            required=True
+        )
+        return opts
+
+    def apply(self, prev):
+        if len(prev) != 1:
+            raise ValueError("DynamicPoolingLayer takes a single input")
+        return [dynamic_pooling(prev[0], self.options.get('rows'))]
@@ -19,4 +19,4 @@ from trainer import Trainer
 from adagrad import AdagradTrainer
 from sgd import SGDTrainer
 
-from train_supervisor import TrainSupervisor, StopTraining
+from train_supervisor import TrainSupervisor, StopTraining, latest_checkpoint
@@ -19,7 +19,7 @@ import theano.tensor as T
 import theano
 import numpy as np
 from nnb.train import Trainer
-from nnb.utils import Options
+from nnb.utils import Options, function_cache
 
 class AdagradTrainer(Trainer):
     """A Trainer to minimize a Model using an adaptative gradient method.
@@ -93,10 +93,17 @@ class AdagradTrainer(Trainer):
         learning_rate = theano.shared(value=learning_rate)
         self.__lr = learning_rate
 
+        self.__state = {'learning_rate': learning_rate}
+        for i, hist in enumerate(adagrad_hist):
+            self.__state['hist_{0}'.format(i)] = hist
+
         for g, pg in zip(grads_hist, params_grads):
             updates[g] = g + pg
 
-        self.__compute_grads = theano.function(inputs, updates=updates)
+        self.__compute_grads = function_cache.function(
+            inputs, updates=updates,
+            key=('AdagradTrainer.compute_grads', self)
+        )
 
         import collections
         updates = collections.OrderedDict()
@@ -109,16 +116,19 @@ class AdagradTrainer(Trainer):
         for g in grads_hist:
             updates[g] = T.zeros_like(g)
 
-        self.__train_with_grads = theano.function([batch_size], [],
-                                                    updates=updates)
+        self.__train_with_grads = function_cache.function(
+            [batch_size], [], updates=updates,
+            key=('AdagradTrainer.train_with_grads', self)
+        )
 
         adagrad_reset_update = [(hist, T.zeros_like(hist))
                                 for hist in adagrad_hist]
 
-        self.__reset_hist = theano.function(
+        self.__reset_hist = function_cache.function(
             inputs=[],
             outputs=None,
-            updates=adagrad_reset_update
+            updates=adagrad_reset_update,
+            key=('AdagradTrainer.reset_hist', self)
         )
 
     def train(self, inputs):
@@ -132,3 +142,8 @@ class AdagradTrainer(Trainer):
         """Sets the learning rate
         """
         self.__lr.set_value(learning_rate)
+
+    def get_state(self):
+        """Returns the learning rate and the adagrad history
+        """
+        return dict(self.__state)
@@ -19,6 +19,7 @@ import nnb
 import theano
 import theano.tensor as T
 import numpy as np
+from nnb.utils import function_cache
 from trainer import Trainer
 
 class SGDTrainer(Trainer):
@@ -70,12 +71,19 @@ class SGDTrainer(Trainer):
             ) for p in params
         ]
 
+        self.__state = {'learning_rate': lr}
+        for i, v in enumerate(velocity):
+            self.__state['velocity_{0}'.format(i)] = v
+
         grads = [T.grad(cost=cost, wrt=param) for param in params]
 
         for hist, grad in zip(grads_hist, grads):
             updates[hist] = hist + grad
 
-        self.__update_grads = theano.function(inputs, [], updates=updates)
+        self.__update_grads = function_cache.function(
+            inputs, [], updates=updates,
+            key=('SGDTrainer.update_grads', self)
+        )
 
         batch_size = T.iscalar()
 
@@ -88,8 +96,10 @@ class SGDTrainer(Trainer):
         for grad in grads_hist:
             updates.append((grad, T.zeros_like(grad)))
 
-        self.__update_params = theano.function([batch_size], [],
-                                                updates=updates)
+        self.__update_params = function_cache.function(
+            [batch_size], [], updates=updates,
+            key=('SGDTrainer.update_params', self)
+        )
 
     def train(self, inputs):
         for inp in inputs:
@@ -100,3 +110,8 @@ class SGDTrainer(Trainer):
         """Sets the learning rate
         """
         self.__lr.set_value(learning_rate)
+
+    def get_state(self):
+        """Returns the learning rate and the velocity of every parameter
+        """
+        return dict(self.__state)
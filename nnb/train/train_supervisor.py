@@ -16,6 +16,8 @@
 #   NNBlocks. If not, see http://www.gnu.org/licenses/.
 
 import nnb
+import os
+import re
 import time
 import nnb.utils as utils
 import numpy as np
@@ -23,7 +25,25 @@ import theano
 import sys
 
 class TrainSupervisor(object):
-    
+    """Runs the training loop of a Trainer.
+
+    :param checkpoint_dir: Optional directory where checkpoints are written
+        (see nnb.utils.checkpoint). If set, the best parameters found are
+        written to the file 'best.ckpt' instead of being kept in memory, and
+        the Model and Trainer are checkpointed every `checkpoint_interval`
+        epochs to 'epoch_N.ckpt'. The snapshots are written by a background
+        thread, so the training doesn't wait for the disk.
+    :param checkpoint_interval: The number of epochs between checkpoints. Set
+        it to 0 to only write the best parameters. Default is 1.
+    :param checkpoint_batches: The number of batches between checkpoints
+        taken in the middle of an epoch, written to 'epoch_N_batch_M.ckpt'.
+        Default is 0, i.e. only checkpoint at the end of epochs.
+    :param max_checkpoints: The number of 'epoch_N*.ckpt' files kept. Older
+        ones are removed. Default is 3.
+    The checkpoints have everything needed to resume the training. See the
+    train method.
+    """
+
     @staticmethod
     def init_options():
         opts = utils.Options()
@@ -81,6 +101,25 @@ class TrainSupervisor(object):
             value_type=bool,
             value=False
         )
+        opts.add(
+            name='checkpoint_dir',
+            value_type=basestring
+        )
+        opts.add(
+            name='checkpoint_interval',
+            value=1,
+            value_type=int
+        )
+        opts.add(
+            name='checkpoint_batches',
+            value=0,
+            value_type=int
+        )
+        opts.add(
+            name='max_checkpoints',
+            value=3,
+            value_type=int
+        )
         return opts
 
     def __init__(self, **kwargs):
@@ -98,7 +137,9 @@ class TrainSupervisor(object):
         inp = io[0]
         outp = io[1]
 
-        self.__eval = theano.function(inp, outp)
+        self.__eval = utils.function_cache.function(
+            inp, outp, key=('TrainSupervisor.eval', eval_model)
+        )
 
         eval_dataset = self.options.get('eval_dataset')
         dataset = self.options.get('dataset')
@@ -141,7 +182,55 @@ class TrainSupervisor(object):
 
         return all_out
 
-    def train(self):
+    def train(self, resume=None):
+        """Runs the training.
+
+        :param resume: Optional path of a checkpoint written by a previous
+            run with the same options, or True for the latest checkpoint in
+            `checkpoint_dir`. The Model, the Trainer state, the nnb.rng state,
+            the order of the examples and the training counters are restored,
+            and the training goes on from the epoch and batch where the
+            checkpoint was taken. Requires the `checkpoint_dir` option.
+        """
+        opts = self.options
+        trainer = opts.get('trainer')
+        model = trainer.options.get('model')
+        eval_model_is_cost = opts.get('eval_model_is_cost')
+        checkpoint_dir = opts.get('checkpoint_dir')
+
+        descriptor = TrainingDescriptor()
+
+        writer = None
+        if checkpoint_dir is not None:
+            if not os.path.isdir(checkpoint_dir):
+                os.makedirs(checkpoint_dir)
+            writer = utils.checkpoint.CheckpointWriter()
+        elif resume is not None:
+            raise ValueError("Resuming the training requires the " +
+                            "'checkpoint_dir' option")
+        if resume is True:
+            resume = latest_checkpoint(checkpoint_dir)
+            if resume is None:
+                print 'No checkpoint to resume from.'
+
+        try:
+            best_params = self.__train_epochs(descriptor, writer, resume)
+        finally:
+            if writer is not None:
+                writer.close()
+
+        print 'Finished!'
+        if eval_model_is_cost:
+            print 'Best error: {0}'.format(descriptor.best_eval_error)
+            if isinstance(best_params, basestring):
+                utils.checkpoint.load(best_params, model, mmap_mode=None)
+            else:
+                for p, new_p in zip(model.params, best_params):
+                    p.set_value(new_p)
+
+    def __train_epochs(self, descriptor, writer, resume):
+        """The training loop. Returns the best parameters, or the path of the
+        file they are written to."""
         opts = self.options
         dataset = opts.get('dataset')
         eval_dataset = opts.get('eval_dataset')
@@ -154,31 +243,99 @@ class TrainSupervisor(object):
         custom_procedures = opts.get('custom_procedures')
         batch_size = opts.get('batch_size')
         eval_model_is_cost = opts.get('eval_model_is_cost')
-
-        descriptor = TrainingDescriptor()
+        checkpoint_dir = opts.get('checkpoint_dir')
+        checkpoint_interval = opts.get('checkpoint_interval')
+        checkpoint_batches = opts.get('checkpoint_batches')
+        max_checkpoints = opts.get('max_checkpoints')
 
         if batch_size is None:
             batch_size = len(dataset)
 
+        #The examples are visited in the order of this permutation, which is
+        #shuffled in place every epoch, so the order can be checkpointed
+        order = np.arange(len(dataset))
         no_improve = 0
         descriptor.best_eval_error = float('Inf')
         best_params = []
-        for epoch in xrange(epochs_num):
+        start_epoch = 0
+        start_batch = 0
+        checkpoints = []
+
+        if resume is not None:
+            utils.checkpoint.load(resume, model, trainer, mmap_mode=None)
+            info, arrays, rng_states = utils.checkpoint.read(resume,
+                                                            mmap_mode=None)
+            nnb.rng.set_state(rng_states['nnb.rng'])
+            order = arrays['order']
+            start_epoch = info['epoch']
+            start_batch = info['batch']
+            no_improve = info['no_improve']
+            for name, value in info['descriptor'].items():
+                setattr(descriptor, name, value)
+            descriptor.last_eval_results = arrays.get('last_eval_results')
+            if info['has_best']:
+                best_params = os.path.join(checkpoint_dir, 'best.ckpt')
+            #The files written before the restart count for max_checkpoints
+            checkpoints = [path for key, path in
+                            _checkpoint_files(checkpoint_dir)]
+            while len(checkpoints) > max_checkpoints:
+                writer.remove(checkpoints.pop(0))
+            print 'Resuming from {0}'.format(resume)
+
+        def checkpoint(epoch, batch, name):
+            descriptor_state = {
+                'epoch_num': descriptor.epoch_num,
+                'last_eval_error': descriptor.last_eval_error,
+                'best_eval_error': descriptor.best_eval_error
+            }
+            for key, value in descriptor_state.items():
+                if value is not None:
+                    descriptor_state[key] = float(value)
+            arrays = {'order': order}
+            results = np.asarray(descriptor.last_eval_results)
+            if descriptor.last_eval_results is not None and \
+                    results.dtype != object:
+                arrays['last_eval_results'] = results
+            info = {
+                'epoch': epoch,
+                'batch': batch,
+                'no_improve': no_improve,
+                'has_best': isinstance(best_params, basestring),
+                'descriptor': descriptor_state
+            }
+            path = os.path.join(checkpoint_dir, name)
+            writer.write(path, utils.checkpoint.snapshot(
+                model, trainer, info=info, arrays=arrays,
+                rngs={'nnb.rng': nnb.rng}))
+            checkpoints.append(path)
+            if len(checkpoints) > max_checkpoints:
+                writer.remove(checkpoints.pop(0))
+
+        for epoch in xrange(start_epoch, epochs_num):
             descriptor.epoch_num = epoch + 1
             print '~Epoch {0}~'.format(epoch + 1)
             init_time = time.time()
-            if permute:
-                nnb.rng.shuffle(dataset)
+            first_batch = 0
+            if epoch == start_epoch and start_batch > 0:
+                #The order of this epoch was restored by the checkpoint
+                first_batch = start_batch
+            elif permute:
+                nnb.rng.shuffle(order)
             iterations = len(dataset) / batch_size
-            for i in xrange(iterations):
+            for i in xrange(first_batch, iterations):
                 si = i * batch_size
                 ei = (i + 1) * batch_size
-                trainer.train(dataset[si:ei])
+                trainer.train(_take(dataset, order[si:ei]))
                 fracs = iterations / 10
                 if fracs > 0 and i % fracs == 0:
                     frac = i / fracs
                     print '\r[{0}{1}]'.format('-' * frac, ' ' * (10 - frac)),
                     sys.stdout.flush()
+                if writer is not None and checkpoint_batches > 0 and \
+                        (i + 1) % checkpoint_batches == 0 and \
+                        i + 1 < iterations:
+                    checkpoint(epoch, i + 1, 'epoch_{0}_batch_{1}.ckpt'
+                                .format(epoch + 1, i + 1))
             print ''
             took_time = time.time() - init_time
             print 'Finished. Took {0} minutes.'.format(took_time / 60)
@@ -195,11 +352,21 @@ class TrainSupervisor(object):
                     if descriptor.last_eval_error < descriptor.best_eval_error:
                         print 'New best!'
                         descriptor.best_eval_error = descriptor.last_eval_error
-                        best_params = [p.get_value().copy()
-                                            for p in model.params]
+                        if writer is None:
+                            best_params = [p.get_value().copy()
+                                                for p in model.params]
+                        else:
+                            best_params = os.path.join(checkpoint_dir,
+                                                        'best.ckpt')
+                            writer.write(best_params,
+                                utils.checkpoint.snapshot(model, info={
+                                    'epoch': epoch + 1,
+                                    'error': float(descriptor.best_eval_error)
+                                }))
                         no_improve = 0
                     else:
                         no_improve += 1
+
             try:
                 for proc in custom_procedures:
                     if isinstance(proc, tuple):
@@ -213,11 +380,42 @@ class TrainSupervisor(object):
             if no_improve == patience:
                 break
 
-        print 'Finished!'
-        if eval_model_is_cost:
-            print 'Best error: {0}'.format(descriptor.best_eval_error)
-            for p, new_p in zip(model.params, best_params):
-                p.set_value(new_p)
+            if writer is not None and checkpoint_interval > 0 and \
+                    (epoch + 1) % checkpoint_interval == 0:
+                checkpoint(epoch + 1, 0, 'epoch_{0}.ckpt'.format(epoch + 1))
+
+        return best_params
+
+def _take(dataset, indexes):
+    if isinstance(dataset, np.ndarray):
+        return dataset[indexes]
+    return [dataset[i] for i in indexes]
+
+_CHECKPOINT_RE = re.compile(r'^epoch_(\d+)(?:_batch_(\d+))?\.ckpt$')
+
+def _checkpoint_files(checkpoint_dir):
+    """The (key, path) pairs of the checkpoints written by a TrainSupervisor
+    in a directory, from the oldest to the latest"""
+    files = []
+    for name in os.listdir(checkpoint_dir):
+        match = _CHECKPOINT_RE.match(name)
+        if match is None:
+            continue
+        epoch, batch = match.groups()
+        #A checkpoint taken at the end of an epoch is later than the ones
+        #taken during that epoch
+        key = (int(epoch), float('Inf') if batch is None else int(batch))
+        files.append((key, os.path.join(checkpoint_dir, name)))
+    return sorted(files)
+
+def latest_checkpoint(checkpoint_dir):
+    """Finds the latest checkpoint written by a TrainSupervisor in a
+    directory. Returns None if there is none.
+    """
+    files = _checkpoint_files(checkpoint_dir)
+    if len(files) == 0:
+        return None
+    return files[-1][1]
 
 
 class StopTraining(Exception):
@@ -112,12 +112,12 @@ class Trainer(object):
     def get_io(self):
         """Returns the Model's inputs and outputs
         This is preferable to calling the Model's get_io method, as this method
-        caches its returns.
+        caches its returns. The graph is built in training mode.
         """
         if self.__io is not None:
             return self.__io
 
-        self.__io = self.options.get('model').get_io()
+        self.__io = self.options.get('model').get_io(train=True)
         return self.__io
 
     def get_cost(self):
@@ -171,6 +171,19 @@ class Trainer(object):
         """
         pass
 
+    def get_state(self):
+        """Method that returns the Trainer's internal state
+        A class that extends the nnb.train.Trainer class and keeps values
+        between calls to train, like a learning rate or gradient histories,
+        should override this method. These values are saved and restored along
+        with the Model's tunable parameters by nnb.utils.checkpoint.
+
+        :returns: A dict from names to the theano shared variables that hold
+            the state. The names should be the same every time the Trainer is
+            built with the same Model.
+        """
+        return {}
+
     def train(self, inputs):
         """Method that adjusts the Model's tunable parameters
         Every class that extends the nnb.train.Trainer class MUST override this
@@ -23,6 +23,13 @@ except ImportError:
     pass
 if matplot_imported:
     import plot_procedure
+import packed_arrays
 import ptb
 from word_vecs import WordVecsHelper
+from neighbors import NeighborIndex
 from options import Options
+import function_cache
+import numpy_runtime
+import checkpoint
+import serving
+import profiling
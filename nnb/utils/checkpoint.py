@@ -0,0 +1,331 @@
+# NNBlocks is a Deep Learning framework for computational linguistics.
+#
+#   Copyright (C) 2015 Frederico Tommasi Caroli
+#
+#   NNBlocks is free software: you can redistribute it and/or modify it under
+#   the terms of the GNU General Public License as published by the Free
+#   Software Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   NNBlocks is distributed in the hope that it will be useful, but WITHOUT ANY
+#   WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+#   FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+#   details.
+#
+#   You should have received a copy of the GNU General Public License along with
+#   NNBlocks. If not, see http://www.gnu.org/licenses/.
+
+"""Checkpoints of Models and Trainers.
+A checkpoint is a nnb.utils.packed_arrays file with the values of the tunable
+parameters of a Model and, optionally, the state of its Trainer (see
+nnb.train.Trainer.get_state). No object is pickled: each parameter is stored
+under its path in the Model tree, so a checkpoint is restored into a Model
+built by the same code, without compiling anything again:
+
+    nnb.utils.checkpoint.save('model.ckpt', model, trainer)
+    #Later, or in another process
+    model = build_model()
+    nnb.utils.checkpoint.load('model.ckpt', model)
+
+The path of a parameter is made of the names of the options that lead from
+the Model to the Model that owns the parameter, joined by dots, followed by
+the parameter name. For example, the W of the second Model of `a | b` is
+'models.1/W'.
+"""
+import os
+import sys
+import Queue
+import threading
+import numpy as np
+from packed_arrays import save_arrays, load_arrays
+
+_FORMAT = 'checkpoint'
+
+def _is_model(obj):
+    import nnb
+    return isinstance(obj, nnb.Model)
+
+def _sub_models(model):
+    """The (path, Model) pairs of the Models in the options of a Model"""
+    subs = []
+    for name in model.options.names():
+        value = model.options.get(name)
+        if _is_model(value):
+            subs.append((name, value))
+        elif isinstance(value, (list, tuple)):
+            for i, v in enumerate(value):
+                if _is_model(v):
+                    subs.append(('{0}.{1}'.format(name, i), v))
+    return subs
+
+def _param_names(params):
+    names = [p.name for p in params]
+    return [name if name is not None and names.count(name) == 1 else str(i)
+            for i, name in enumerate(names)]
+
+def model_paths(model):
+    """Lists the Models of a Model tree with their paths, inner Models first.
+    The Model itself has the path ''. A Model found more than once is only
+    listed with its first path.
+
+    :returns: A list of (path, Model) tuples
+    """
+    models = []
+    seen = set()
+
+    def walk(m, path):
+        if id(m) in seen:
+            return
+        seen.add(id(m))
+        for name, sub in _sub_models(m):
+            walk(sub, name if path == '' else path + '.' + name)
+        models.append((path, m))
+
+    walk(model, '')
+    return models
+
+def _join(path, name):
+    return path + '/' + name if path != '' else name
+
+def param_paths(model):
+    """Lists the tunable parameters of a Model with their paths.
+    A parameter shared by several Models gets the path of the first one found.
+
+    :returns: A list of (path, shared variable) tuples, in the order of
+        model.params
+    """
+    paths = {}
+    #Inner Models claim their parameters before the Models that hold them
+    for path, m in model_paths(model):
+        for p, name in zip(m.params, _param_names(m.params)):
+            if p not in paths:
+                paths[p] = _join(path, name)
+    return [(paths[p], p) for p in model.params]
+
+def _random_states(model):
+    """The (path, shared variable, seed) tuples of the RandomState variables
+    drawn by the RandomStreams of a Model tree, like the DropoutLayer's.
+    A RandomStreams draws a new variable, with a new seed, each time a graph
+    is built. The seeds only depend on the RandomStreams' seed and on the
+    number of variables drawn before, so a variable is named after both and
+    building more graphs only adds new names.
+    """
+    from theano.tensor.shared_randomstreams import RandomStreams
+    states = []
+    for path, m in model_paths(model):
+        for attr, value in sorted(vars(m).items()):
+            if isinstance(value, RandomStreams):
+                seed = value.default_instance_seed
+                seedgen = np.random.RandomState(seed)
+                for i, (var, update) in enumerate(value.state_updates):
+                    name = '{0}_{1}_{2}'.format(attr, seed, i)
+                    states.append((_join(path, name), var,
+                                    int(seedgen.randint(2 ** 30))))
+    return states
+
+def _split_rng_state(rng):
+    """A RandomState's state as an array and a JSON serializable list"""
+    name, keys, pos, has_gauss, cached_gaussian = rng.get_state()
+    return keys, [pos, has_gauss, cached_gaussian]
+
+def _join_rng_state(keys, rest):
+    return ('MT19937', np.array(keys, dtype='uint32'), rest[0], rest[1],
+            rest[2])
+
+def snapshot(model, trainer=None, info=None, arrays=None, rngs=None):
+    """Copies the values to be checkpointed.
+    The copies can be written later by `write`, for example by another thread,
+    while the training goes on. Besides the tunable parameters, the state of
+    the random streams of the Model is saved, so Models like the DropoutLayer
+    draw the same numbers after the checkpoint is loaded.
+
+    :param info: Optional JSON serializable object stored in the checkpoint.
+    :param arrays: Optional dict of other arrays to be stored.
+    :param rngs: Optional dict of numpy RandomStates whose states are stored.
+    :returns: A tuple (arrays, meta) to be given to `write`
+    """
+    snap = []
+    params = []
+    for path, p in param_paths(model):
+        snap.append(('param:' + path, p.get_value()))
+        params.append(path)
+    state = []
+    if trainer is not None:
+        for name, var in trainer.get_state().items():
+            snap.append(('trainer:' + name, np.asarray(var.get_value())))
+            state.append(name)
+    random = {}
+    for path, var, seed in _random_states(model):
+        keys, random[path] = _split_rng_state(var.get_value(borrow=True))
+        snap.append(('random:' + path, keys.copy()))
+    rng_states = {}
+    for name, rng in (rngs or {}).items():
+        keys, rng_states[name] = _split_rng_state(rng)
+        snap.append(('rng:' + name, keys))
+    extra = []
+    for name, a in (arrays or {}).items():
+        snap.append(('extra:' + name, np.array(a)))
+        extra.append(name)
+    meta = {'format': _FORMAT, 'params': params, 'trainer': state,
+            'random': random, 'rngs': rng_states, 'extra': extra,
+            'info': info}
+    return snap, meta
+
+def write(filename, snap):
+    """Writes a snapshot taken by `snapshot` to a file."""
+    arrays, meta = snap
+    save_arrays(filename, arrays, meta=meta)
+
+def save(filename, model, trainer=None, info=None, arrays=None, rngs=None):
+    """Saves the tunable parameters of a Model and, optionally, the state of
+    its Trainer. See `snapshot` for the parameters.
+    The info is returned by `load` and `read`, the arrays and the states of
+    the rngs by `read`.
+    """
+    write(filename, snapshot(model, trainer, info, arrays, rngs))
+
+def _restore(var, value, what):
+    current = var.get_value(borrow=True)
+    shape = getattr(current, 'shape', ())
+    if value.shape != shape:
+        raise ValueError("The shape of {0} is {1} in the checkpoint, but {2} "
+                        "in the Model".format(what, value.shape, shape))
+    if value.ndim == 0:
+        value = value[()]
+    var.set_value(value, borrow=True)
+
+def _load(filename, mmap_mode):
+    arrays, meta = load_arrays(filename, mmap_mode=mmap_mode)
+    if not isinstance(meta, dict) or meta.get('format') != _FORMAT:
+        raise ValueError("{0} is not a checkpoint".format(filename))
+    return arrays, meta
+
+def load(filename, model, trainer=None, mmap_mode='c'):
+    """Restores a checkpoint into an existing Model and, optionally, Trainer.
+    The Model and the Trainer should have been built the same way as the ones
+    that were saved. Since only the values of the shared variables change,
+    functions already compiled keep working.
+
+    :param mmap_mode: The mode used to memory-map the parameters (see
+        numpy.memmap). The default, 'c', maps them copy-on-write: loading
+        takes constant time and only the pages of a parameter that are
+        actually updated by training are copied to memory. Set it to None to
+        read every parameter into memory.
+    :returns: The info object given to `save`
+    """
+    arrays, meta = _load(filename, mmap_mode)
+
+    paths = param_paths(model)
+    saved = set(meta['params'])
+    missing = [path for path, p in paths if path not in saved]
+    if len(missing) > 0 or len(paths) != len(saved):
+        raise ValueError("The checkpoint doesn't match the Model. Missing " +
+                        "parameters: {0}".format(missing))
+    for path, p in paths:
+        _restore(p, arrays['param:' + path], path)
+
+    #The random streams only have states after a graph is built, and the
+    #Model may have built more or less graphs than the saved one. A state
+    #that isn't in the checkpoint wasn't drawn yet, so it starts anew.
+    if 'random' in meta:
+        random = meta['random']
+        for path, var, seed in _random_states(model):
+            if path in random:
+                rng = var.get_value(borrow=True)
+                rng.set_state(_join_rng_state(arrays['random:' + path],
+                                            random[path]))
+            else:
+                rng = np.random.RandomState(seed)
+            var.set_value(rng, borrow=True)
+
+    if trainer is not None:
+        state = trainer.get_state()
+        if sorted(state.keys()) != sorted(meta['trainer']):
+            raise ValueError("The checkpoint doesn't have the state of the " +
+                            "Trainer")
+        for name, var in state.items():
+            _restore(var, arrays['trainer:' + name], name)
+
+    return meta['info']
+
+def read(filename, mmap_mode='c'):
+    """Reads what was saved besides the Model and the Trainer.
+
+    :returns: A tuple (info, arrays, rng_states), where arrays is a dict of
+        the arrays given to `save` and rng_states is a dict with the states of
+        the rngs given to `save`, to be restored with RandomState.set_state.
+    """
+    arrays, meta = _load(filename, mmap_mode)
+    extra = dict((name, arrays['extra:' + name])
+                for name in meta.get('extra', []))
+    rng_states = dict((name, _join_rng_state(arrays['rng:' + name], rest))
+                    for name, rest in meta.get('rngs', {}).items())
+    return meta['info'], extra, rng_states
+
+class CheckpointWriter(object):
+    """Writes snapshots to disk in a background thread.
+    The snapshots are taken by the caller, so they don't change while they
+    are written, and the files are written and removed in the order they are
+    given. At most max_pending snapshots wait to be written: after that, write
+    blocks, so a slow disk can't make the snapshots pile up in memory. With
+    the one being written, up to max_pending + 1 snapshots are held in
+    memory, besides the one the caller takes next.
+    An error in the background thread is raised again by the next call.
+
+        writer = CheckpointWriter()
+        writer.write('epoch_1.ckpt', snapshot(model, trainer))
+        #...
+        writer.close()
+    """
+
+    def __init__(self, max_pending=1):
+        self._queue = Queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            try:
+                if task is None:
+                    return
+                if self._error is None:
+                    task[0](*task[1:])
+            except Exception:
+                self._error = sys.exc_info()
+            finally:
+                self._queue.task_done()
+
+    def _check(self):
+        if self._error is not None:
+            error = self._error
+            self._error = None
+            raise error[0], error[1], error[2]
+
+    def _submit(self, *task):
+        self._check()
+        if not self._thread.is_alive():
+            raise ValueError("The CheckpointWriter is closed")
+        self._queue.put(task)
+
+    def write(self, filename, snap):
+        """Writes a snapshot taken by `snapshot` to filename."""
+        self._submit(write, filename, snap)
+
+    def remove(self, filename):
+        """Removes a file after the snapshots given before are written."""
+        self._submit(os.remove, filename)
+
+    def flush(self):
+        """Waits until everything given is written."""
+        self._queue.join()
+        self._check()
+
+    def close(self):
+        """Writes everything given and stops the background thread."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._check()
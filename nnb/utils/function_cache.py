@@ -0,0 +1,313 @@
+# NNBlocks is a Deep Learning framework for computational linguistics.
+#
+#   Copyright (C) 2015 Frederico Tommasi Caroli
+#
+#   NNBlocks is free software: you can redistribute it and/or modify it under
+#   the terms of the GNU General Public License as published by the Free
+#   Software Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   NNBlocks is distributed in the hope that it will be useful, but WITHOUT ANY
+#   WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+#   FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+#   details.
+#
+#   You should have received a copy of the GNU General Public License along with
+#   NNBlocks. If not, see http://www.gnu.org/licenses/.
+
+"""On-disk cache of compiled theano functions.
+Compiling and optimizing the graph of a big Model can take minutes. This
+module keeps the optimized functions in a directory, keyed by a fingerprint of
+the objects that built the graph (Model and Trainer types, options and
+parameter shapes), the compile parameters and the theano configuration, so
+later runs and worker processes skip the optimization.
+The cache is off by default. Turn it on with set_cache_dir or with the
+NNB_FUNCTION_CACHE_DIR environment variable.
+Cached functions are saved without the values of their shared variables. When
+a function is loaded, it is bound to the shared variables of the graph that
+was just built, so it updates the live Model parameters.
+"""
+import os
+import sys
+import types
+import hashlib
+import warnings
+import cPickle as pickle
+import numpy as np
+import theano
+import theano.tensor as T
+from theano.gof import graph
+from nnb.utils.options import Options
+
+_cache_dir = os.environ.get('NNB_FUNCTION_CACHE_DIR')
+
+def set_cache_dir(path):
+    """Sets the cache directory. Set it to None to turn the cache off.
+    """
+    global _cache_dir
+    _cache_dir = path
+
+def get_cache_dir():
+    return _cache_dir
+
+class _Uncacheable(Exception):
+    pass
+
+def _class_path(cls):
+    return cls.__module__ + '.' + cls.__name__
+
+def _is_block(obj):
+    return isinstance(getattr(obj, 'options', None), Options)
+
+def _code_names(code):
+    """The global and attribute names used by a code object and the code
+    objects it defines, like the ones of lambdas"""
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= _code_names(const)
+    return names
+
+def _describe(obj, memo):
+    """Builds a nested structure of strings and tuples describing obj.
+    Objects with an identity (Models, shared variables, arrays...) are numbered
+    the first time they are seen and referenced by their number afterwards,
+    so sharing between Models is part of the description.
+    Arrays are described by their dtype and shape only: their values end up
+    in shared variables, which are relinked when a function is loaded, or in
+    constants of the graph, which are described by _constants.
+    """
+    if obj is None or isinstance(obj, (bool, int, long, float, complex, str,
+                                        unicode, slice)):
+        return repr(obj)
+    if isinstance(obj, (type, types.ClassType)):
+        return ('class', _class_path(obj))
+    if isinstance(obj, types.ModuleType):
+        return ('module', obj.__name__)
+    if isinstance(obj, (list, tuple)):
+        return (type(obj).__name__,) + tuple(_describe(o, memo) for o in obj)
+    if isinstance(obj, np.generic):
+        return ('scalar', obj.dtype.str, repr(obj))
+
+    if id(obj) in memo:
+        return ('ref', memo[id(obj)][0])
+    memo[id(obj)] = (len(memo), obj)
+
+    if isinstance(obj, dict):
+        items = [(_describe(k, memo), _describe(v, memo))
+                for k, v in obj.items()]
+        return ('dict',) + tuple(sorted(items))
+    if isinstance(obj, np.ndarray):
+        return ('array', obj.dtype.str, obj.shape)
+    if isinstance(obj, theano.compile.SharedVariable):
+        value = obj.get_value(borrow=True)
+        #An array that became a parameter doesn't take part in the graph
+        if id(value) not in memo:
+            memo[id(value)] = (len(memo), value)
+        return ('shared', str(obj.type), getattr(value, 'shape', None))
+    if isinstance(obj, graph.Variable):
+        raise _Uncacheable("Theano variables can't be fingerprinted")
+    if isinstance(obj, theano.gof.Op):
+        return ('op', _class_path(type(obj)), str(obj))
+    if isinstance(obj, types.CodeType):
+        return ('code', obj.co_code, _describe(obj.co_consts, memo),
+                obj.co_names)
+    if isinstance(obj, types.FunctionType):
+        code = obj.func_code
+        closure = [c.cell_contents for c in obj.func_closure or []]
+        #The module globals it uses, like the functions it calls
+        names = sorted(n for n in _code_names(code) if n in obj.func_globals)
+        globs = tuple((n, _describe(obj.func_globals[n], memo)) for n in names)
+        return ('function', obj.__module__, code.co_code,
+                _describe(code.co_consts, memo), code.co_names,
+                _describe(obj.func_defaults, memo), _describe(closure, memo),
+                globs)
+    if isinstance(obj, types.BuiltinFunctionType):
+        return ('builtin', repr(obj))
+    if _is_block(obj):
+        #Models and Trainers. Parameters and inner blocks go first, so the
+        #numbering doesn't depend on the order of dicts keyed by parameters.
+        params = getattr(obj, 'params', None) or []
+        options = obj.options
+        names = options.names()
+        params = _describe(params, memo)
+        values = {}
+        for name in sorted(names, key=lambda n: not _is_block(options.get(n))):
+            values[name] = _describe(options.get(name), memo)
+        return ('block', _class_path(type(obj)), params,
+                tuple((name, values[name]) for name in names))
+
+    #Anything else is described by its attributes or, if it has none, by its
+    #repr
+    if hasattr(obj, '__dict__'):
+        return ('object', _class_path(obj.__class__), _describe(vars(obj), memo))
+    return ('object', _class_path(type(obj)), repr(obj))
+
+def fingerprint(*objs):
+    """Hex digest that identifies the graph built by a set of objects.
+
+    :param objs: Models, Trainers, options values or any of the basic python
+        types.
+    """
+    description = _describe(objs, {})
+    return hashlib.sha1(repr(description)).hexdigest()
+
+def _graph_inputs(outputs, updates):
+    variables = list(outputs)
+    for var, update in updates:
+        variables += [var, update]
+    return graph.inputs(variables)
+
+def _shared_inputs(variables):
+    shared = []
+    seen = set()
+    for var in variables:
+        if isinstance(var, theano.compile.SharedVariable) and \
+                var not in seen:
+            seen.add(var)
+            shared.append(var)
+    return shared
+
+def _constants(variables):
+    """Describes the array constants of a graph, which are saved with the
+    cached function. Most graphs only have small ones."""
+    constants = []
+    for var in variables:
+        if isinstance(var, graph.Constant) and \
+                isinstance(var.data, np.ndarray):
+            data = np.ascontiguousarray(var.data)
+            constants.append((str(var.type), data.shape,
+                            hashlib.sha1(data.data).hexdigest()))
+    return sorted(constants)
+
+def _dummy_value(var):
+    if not isinstance(var.type, T.TensorType):
+        return None
+    return np.zeros((1,) * var.ndim, dtype=var.dtype)
+
+def _same_type(type1, type2):
+    #Types like RandomStateType compare by identity, so an unpickled one is
+    #never equal to the live one
+    return type1 == type2 or \
+            (type(type1) is type(type2) and str(type1) == str(type2))
+
+def _shape(var):
+    return getattr(var.get_value(borrow=True), 'shape', None)
+
+def _load(path, shared, name):
+    """Links a cached function to the shared variables in `shared`.
+    The optimized graph is unpickled as is, with the features the optimizer
+    attached to it, and only the storage of the shared variables is replaced.
+    """
+    with open(path, 'rb') as fin:
+        state = pickle.load(fin)
+    maker = state['maker']
+
+    for position, index, shape in state['shared']:
+        inp = maker.inputs[position]
+        if index >= len(shared) or \
+                not _same_type(inp.variable.type, shared[index].type) or \
+                _shape(shared[index]) != shape:
+            raise ValueError("The cached function doesn't match the graph")
+        inp.variable = shared[index]
+        inp.value = shared[index].container
+
+    fn = maker.create([getattr(inp, 'value', None) for inp in maker.inputs])
+    fn.name = name
+    return fn
+
+def _save(path, fn, shared):
+    index = dict((var, i) for i, var in enumerate(shared))
+    entries = []
+    containers = []
+    for position, inp in enumerate(fn.maker.inputs):
+        var = inp.variable
+        if not isinstance(var, theano.compile.SharedVariable):
+            continue
+        if var not in index:
+            raise _Uncacheable("A shared variable isn't part of the graph")
+        entries.append((position, index[var], _shape(var)))
+        dummy = _dummy_value(var)
+        if dummy is not None:
+            containers.append((var.container, var.container.storage[0]))
+            var.container.storage[0] = dummy
+
+    tmp_path = path + '.{0}.tmp'.format(os.getpid())
+    old_limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(old_limit, 100000))
+    try:
+        #The parameters are swapped for small dummy values while pickling
+        with open(tmp_path, 'wb') as fout:
+            pickle.dump({'maker': fn.maker, 'shared': entries}, fout,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+    finally:
+        for container, value in containers:
+            container.storage[0] = value
+        sys.setrecursionlimit(old_limit)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def function(inputs, outputs=None, updates=None, key=None, **kwargs):
+    """theano.function with an on-disk cache.
+    If the cache is off or no key is given, this is just theano.function.
+
+    :param key: The objects that built the graph, as accepted by fingerprint.
+        The key must tell apart every graph that can be built, so it should
+        include everything, besides the Models, that changes the graph. For
+        example, Model.compile uses ('Model.compile', model, train).
+    :param **kwargs: Every other parameter is passed to theano.function and
+        is part of the key.
+    """
+    if updates is None:
+        updates = []
+    if isinstance(updates, dict):
+        updates = updates.items()
+    if _cache_dir is None or key is None:
+        return theano.function(inputs, outputs, updates=updates, **kwargs)
+
+    if outputs is None:
+        output_list = []
+    elif isinstance(outputs, (list, tuple)):
+        output_list = list(outputs)
+    else:
+        output_list = [outputs]
+    graph_inputs = _graph_inputs(output_list, updates)
+    shared = _shared_inputs(graph_inputs)
+    config = theano.config
+    try:
+        digest = fingerprint(
+            key, kwargs,
+            [str(getattr(i, 'type', i)) for i in inputs],
+            [str(s.type) for s in shared], _constants(graph_inputs),
+            isinstance(outputs, (list, tuple)), len(output_list),
+            len(updates), theano.__version__, config.floatX, config.device,
+            config.mode, config.optimizer, config.linker
+        )
+    except _Uncacheable:
+        return theano.function(inputs, outputs, updates=updates, **kwargs)
+    path = os.path.join(_cache_dir, digest + '.pkl')
+
+    if os.path.exists(path):
+        try:
+            return _load(path, shared, kwargs.get('name'))
+        except Exception as e:
+            warnings.warn(("Couldn't load the cached function {0}: {1}. " +
+                        "Compiling it again.").format(path, e), RuntimeWarning)
+
+    fn = theano.function(inputs, outputs, updates=updates, **kwargs)
+    try:
+        if not os.path.isdir(_cache_dir):
+            try:
+                os.makedirs(_cache_dir)
+            except OSError:
+                #Another process may have just created it
+                if not os.path.isdir(_cache_dir):
+                    raise
+        _save(path, fn, shared)
+    except _Uncacheable:
+        pass
+    except Exception as e:
+        warnings.warn("Couldn't save the compiled function to the cache: " +
+                    "{0}".format(e), RuntimeWarning)
+    return fn
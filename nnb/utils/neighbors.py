@@ -0,0 +1,181 @@
+# NNBlocks is a Deep Learning framework for computational linguistics.
+#
+#   Copyright (C) 2015 Frederico Tommasi Caroli
+#
+#   NNBlocks is free software: you can redistribute it and/or modify it under
+#   the terms of the GNU General Public License as published by the Free
+#   Software Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   NNBlocks is distributed in the hope that it will be useful, but WITHOUT ANY
+#   WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+#   FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+#   details.
+#
+#   You should have received a copy of the GNU General Public License along with
+#   NNBlocks. If not, see http://www.gnu.org/licenses/.
+
+"""Module that defines the NeighborIndex class.
+"""
+import numpy as np
+
+def _top_k(sims, k):
+    """Indexes of the k largest values of each row, unsorted"""
+    if sims.shape[1] <= k:
+        return np.tile(np.arange(sims.shape[1]), (sims.shape[0], 1))
+    return np.argpartition(-sims, k - 1, axis=1)[:, :k]
+
+def _sort_rows(indexes, sims):
+    order = np.argsort(-sims, axis=1)
+    rows = np.arange(sims.shape[0])[:, None]
+    return indexes[rows, order], sims[rows, order]
+
+class NeighborIndex(object):
+    """Cosine similarity index over a table of vectors.
+    The vectors are normalized once, so a similarity is a dot product. Exact
+    queries are answered in blocks of queries and blocks of vectors with
+    matrix products, keeping only a running top k of each query. The
+    approximate mode hashes the vectors with random hyperplanes (several hash
+    tables of `bits` hyperplanes each) and only compares a query with the
+    vectors that fall in the same buckets.
+    For example, to query the word vectors of a WordVecsHelper or of a trained
+    nnb.Picker:
+
+        index = NeighborIndex(helper.word_vecs, word2index=helper.word2index)
+        index.most_similar('king')
+        index = NeighborIndex(picker.params[0].get_value(borrow=True))
+        indexes, similarities = index.query(some_vectors, k=5)
+    """
+
+    def __init__(self, vectors, word2index=None, approximate=False, bits=None,
+                tables=4, query_block=256, vector_block=65536, seed=1337):
+        """
+        :param vectors: A matrix where each row is a vector.
+        :param word2index: Optional dict from words to row indexes. This is
+            needed by most_similar.
+        :param approximate: If True, queries are answered approximately with
+            random hyperplane hashing. Default is False.
+        :param bits: The number of hyperplanes of each hash table. Default is
+            enough bits for about 64 vectors per bucket.
+        :param tables: The number of hash tables. More tables give better
+            recall and slower queries. Default is 4.
+        :param query_block: The number of queries compared at once in exact
+            queries.
+        :param vector_block: The number of vectors compared at once in exact
+            queries.
+        :param seed: The seed for the random hyperplanes.
+        """
+        #Only the normalized vectors are a full size copy
+        vectors = np.ascontiguousarray(vectors, dtype='float32')
+        norms = np.sqrt(np.einsum('ij,ij->i', vectors, vectors))
+        norms[norms == 0] = 1.
+        self.vectors = vectors / norms[:, None]
+        self.word2index = word2index
+        self.index2word = None
+        if word2index is not None:
+            self.index2word = [None] * len(vectors)
+            for word, index in word2index.items():
+                self.index2word[index] = word
+        self.query_block = query_block
+        self.vector_block = vector_block
+        self.approximate = approximate
+
+        if approximate:
+            if bits is None:
+                bits = max(1, int(np.log2(len(vectors) / 64.)))
+            rng = np.random.RandomState(seed)
+            self._planes = []
+            self._buckets = []
+            for _ in range(tables):
+                planes = rng.normal(size=(vectors.shape[1], bits))
+                planes = np.asarray(planes, dtype='float32')
+                codes = self._hash(self.vectors, planes)
+                order = np.argsort(codes, kind='mergesort')
+                uniq, starts = np.unique(codes[order], return_index=True)
+                ends = np.append(starts[1:], len(order))
+                buckets = {}
+                for code, start, end in zip(uniq, starts, ends):
+                    buckets[code] = order[start:end]
+                self._planes.append(planes)
+                self._buckets.append(buckets)
+
+    @staticmethod
+    def _hash(vectors, planes):
+        bits = vectors.dot(planes) > 0
+        return bits.dot(1 << np.arange(planes.shape[1], dtype='int64'))
+
+    def _normalize_queries(self, queries):
+        queries = np.asarray(queries, dtype='float32')
+        if queries.ndim == 1:
+            queries = queries[None, :]
+        norms = np.sqrt(np.square(queries).sum(axis=1))
+        norms[norms == 0] = 1.
+        return queries / norms[:, None]
+
+    def query(self, queries, k=10):
+        """Finds the k most similar vectors of each query.
+
+        :param queries: A vector or a matrix where each row is a query.
+        :param k: The number of neighbors. Default is 10.
+        :returns: A tuple (indexes, similarities) of matrices with one row per
+            query, sorted from the most similar to the least similar. In the
+            approximate mode, rows with less than k candidates are padded with
+            index -1 and similarity -inf.
+        """
+        queries = self._normalize_queries(queries)
+        if self.approximate:
+            return self._approximate_query(queries, k)
+
+        all_indexes = []
+        all_sims = []
+        for qs in xrange(0, len(queries), self.query_block):
+            q = queries[qs:qs + self.query_block]
+            best_indexes = np.zeros((len(q), 0), dtype='int64')
+            best_sims = np.zeros((len(q), 0), dtype='float32')
+            for vs in xrange(0, len(self.vectors), self.vector_block):
+                sims = q.dot(self.vectors[vs:vs + self.vector_block].T)
+                top = _top_k(sims, k)
+                rows = np.arange(len(q))[:, None]
+                sims = np.concatenate([best_sims, sims[rows, top]], axis=1)
+                indexes = np.concatenate([best_indexes, top + vs], axis=1)
+                top = _top_k(sims, k)
+                best_sims = sims[rows, top]
+                best_indexes = indexes[rows, top]
+            best_indexes, best_sims = _sort_rows(best_indexes, best_sims)
+            all_indexes.append(best_indexes)
+            all_sims.append(best_sims)
+
+        return np.concatenate(all_indexes), np.concatenate(all_sims)
+
+    def _approximate_query(self, queries, k):
+        indexes = np.full((len(queries), k), -1, dtype='int64')
+        sims = np.full((len(queries), k), -np.inf, dtype='float32')
+        codes = [self._hash(queries, planes) for planes in self._planes]
+
+        for i, q in enumerate(queries):
+            candidates = [buckets.get(c[i]) for buckets, c in
+                            zip(self._buckets, codes)]
+            candidates = [c for c in candidates if c is not None]
+            if len(candidates) == 0:
+                continue
+            candidates = np.unique(np.concatenate(candidates))
+            c_sims = self.vectors[candidates].dot(q)
+            top = _top_k(c_sims[None, :], k)[0]
+            top = top[np.argsort(-c_sims[top])]
+            indexes[i, :len(top)] = candidates[top]
+            sims[i, :len(top)] = c_sims[top]
+
+        return indexes, sims
+
+    def most_similar(self, word, k=10):
+        """Finds the k words most similar to a word, leaving the word out.
+
+        :returns: A list of (word, similarity) tuples, from the most similar
+            to the least similar.
+        """
+        if self.word2index is None:
+            raise ValueError("The index was built without a word2index dict")
+        index = self.word2index[word]
+        indexes, sims = self.query(self.vectors[index], k + 1)
+        return [(self.index2word[i], s) for i, s in zip(indexes[0], sims[0])
+                if i != index and i >= 0][:k]
@@ -0,0 +1,530 @@
+# NNBlocks is a Deep Learning framework for computational linguistics.
+#
+#   Copyright (C) 2015 Frederico Tommasi Caroli
+#
+#   NNBlocks is free software: you can redistribute it and/or modify it under
+#   the terms of the GNU General Public License as published by the Free
+#   Software Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   NNBlocks is distributed in the hope that it will be useful, but WITHOUT ANY
+#   WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+#   FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+#   details.
+#
+#   You should have received a copy of the GNU General Public License along with
+#   NNBlocks. If not, see http://www.gnu.org/licenses/.
+
+"""Inference of trained Models with NumPy only.
+The export function walks a Model and writes its structure and parameters to
+a single file (see nnb.utils.packed_arrays). The load function reads it back
+as a NumpyModel, a callable that computes the same outputs as
+model.compile(), without building or compiling any theano graph.
+Only exporting needs theano. This module and packed_arrays.py only import
+numpy, so they can be shipped on their own to the machines that serve the
+Model:
+
+    #Training machine
+    nnb.utils.numpy_runtime.export(model, 'model.nnb')
+
+    #Serving machine
+    import numpy_runtime
+    f = numpy_runtime.load('model.nnb')
+    f([1, 6, 12, 7])
+
+The supported Models are InputLayer, Picker, ConcatenationModel, SliceModel,
+CustomModel, PerceptronLayer, DropoutLayer, SoftmaxLayer,
+RecurrentNeuralNetwork with SimpleRecurrence or LSTMRecurrence (or any other
+supported recurrence Model), RecursiveNeuralNetwork, ConvolutionalLayer,
+ConvolutionalBank, MaxPoolingLayer, MaxOverTimePoolingLayer and the joins of
+these Models. Activation functions are looked up in the `activations` dict.
+CustomModel functions build theano graphs, so they have to be given again as
+NumPy functions when loading, in the custom_fns dict, under the name of the
+original function.
+"""
+import numpy as np
+from packed_arrays import save_arrays, load_arrays
+
+_FORMAT = 'numpy_runtime'
+
+def _sigmoid(a):
+    with np.errstate(over='ignore'):
+        return 1. / (1. + np.exp(-a))
+
+def _softmax(a):
+    if a.ndim == 1:
+        #theano's softmax turns vectors into single row matrices
+        a = a[None, :]
+    e = np.exp(a - a.max(axis=-1, keepdims=True))
+    return e / e.sum(axis=-1, keepdims=True)
+
+def _leaky_relu(a, alpha):
+    f1 = 0.5 * (a + alpha)
+    f2 = 0.5 * (a - alpha)
+    return f1 * a + f2 * abs(a)
+
+def _threshold(a, t, yes, no):
+    return np.where(a >= t, yes, no)
+
+activations = {
+    'sigmoid': _sigmoid,
+    'tanh': np.tanh,
+    'linear': lambda a: a,
+    'relu': lambda a: 0.5 * (a + abs(a)),
+    'leaky_relu': _leaky_relu,
+    'threshold': _threshold,
+    'softmax': _softmax,
+    'exp': np.exp
+}
+"""NumPy versions of the activation functions, by name. The exported
+activation specs have a 'name' and the keyword arguments of the function.
+"""
+
+def _theano_activations():
+    import theano.tensor as T
+    import nnb.activation as act
+    return [
+        (act.sigmoid, 'sigmoid'),
+        (T.nnet.sigmoid, 'sigmoid'),
+        (act.tanh, 'tanh'),
+        (T.tanh, 'tanh'),
+        (act.linear, 'linear'),
+        (act.ReLU, 'relu'),
+        (T.nnet.relu, 'relu'),
+        (T.nnet.softmax, 'softmax'),
+        (T.exp, 'exp')
+    ]
+
+def _activation_spec(fn):
+    """The JSON spec of an activation function or None if it is unknown."""
+    import nnb.activation as act
+    for f, name in _theano_activations():
+        if fn is f:
+            return {'name': name}
+
+    #The activations with parameters are closures. Their code object is
+    #shared by every closure built by the same function.
+    code = getattr(fn, 'func_code', None)
+    if code is None:
+        return None
+    cells = [c.cell_contents for c in fn.func_closure or []]
+    kwargs = dict(zip(code.co_freevars, cells))
+    if code is act.leaky_ReLU(0.).func_code:
+        return {'name': 'leaky_relu', 'alpha': float(kwargs['alpha'])}
+    if code is act.threshold(0.).func_code:
+        return {'name': 'threshold', 't': float(kwargs['t']),
+                'yes': float(kwargs['yes']), 'no': float(kwargs['no'])}
+    return None
+
+def _index_spec(index):
+    if index is None or isinstance(index, (int, long)):
+        return index
+    if isinstance(index, np.integer):
+        return int(index)
+    if isinstance(index, slice):
+        return {'slice': [_index_spec(index.start), _index_spec(index.stop),
+                        _index_spec(index.step)]}
+    if isinstance(index, tuple):
+        return {'tuple': [_index_spec(i) for i in index]}
+    if isinstance(index, list):
+        return {'list': [_index_spec(i) for i in index]}
+    if index is Ellipsis:
+        return {'ellipsis': True}
+    raise ValueError("Can't export the slice {0}".format(index))
+
+def _index_value(spec):
+    if not isinstance(spec, dict):
+        return spec
+    if 'slice' in spec:
+        return slice(*[_index_value(i) for i in spec['slice']])
+    if 'tuple' in spec:
+        return tuple(_index_value(i) for i in spec['tuple'])
+    if 'list' in spec:
+        return [_index_value(i) for i in spec['list']]
+    return Ellipsis
+
+class _Exporter(object):
+    """Builds the spec of a Model.
+    The spec is a list of nodes, one per Model, and each node refers to other
+    nodes and to the parameters by their position. Models and parameters
+    shared by several parts of the Model are exported once.
+    """
+
+    def __init__(self, model):
+        self.nodes = []
+        self.arrays = []
+        self._node_ids = {}
+        self._param_names = {}
+        self._input_ids = {}
+        try:
+            inputs = model._get_inputs()
+        except NotImplementedError:
+            inputs = []
+        self.inputs = []
+        for i, inp in enumerate(inputs):
+            self._input_ids[id(inp)] = i
+            self.inputs.append({'name': inp.name, 'ndim': inp.ndim,
+                                'dtype': inp.dtype})
+        self.root = self.node(model)
+
+    def param(self, p):
+        if id(p) not in self._param_names:
+            name = 'p{0}'.format(len(self.arrays))
+            self._param_names[id(p)] = name
+            self.arrays.append((name, p.get_value(borrow=True)))
+        return self._param_names[id(p)]
+
+    def params(self, params):
+        return [self.param(p) for p in params]
+
+    def activation(self, model, fn):
+        spec = _activation_spec(fn)
+        if spec is None:
+            raise ValueError("Can't export the activation function {0} of {1}"
+                            .format(fn, type(model).__name__))
+        return spec
+
+    def node(self, model):
+        if id(model) in self._node_ids:
+            return self._node_ids[id(model)]
+        spec = self._spec(model)
+        self._node_ids[id(model)] = len(self.nodes)
+        self.nodes.append(spec)
+        return len(self.nodes) - 1
+
+    def _spec(self, model):
+        import nnb
+        from nnb.model import VerticalJoinModel, HorizontalJoinModel
+        opts = model.options
+        cls = type(model)
+
+        if cls is HorizontalJoinModel or cls is VerticalJoinModel:
+            kind = 'horizontal' if cls is HorizontalJoinModel else 'vertical'
+            return {'type': kind,
+                    'models': [self.node(m) for m in opts.get('models')]}
+        if cls is nnb.InputLayer:
+            inp = model._get_inputs()[0]
+            if id(inp) not in self._input_ids:
+                raise ValueError(("The InputLayer {0} isn't an input of the " +
+                                "exported Model").format(inp.name))
+            return {'type': 'input', 'input': self._input_ids[id(inp)]}
+        if cls is nnb.Picker:
+            return {'type': 'picker', 'params': self.params(model.params)}
+        if cls is nnb.ConcatenationModel:
+            return {'type': 'concatenation', 'axis': opts.get('axis')}
+        if cls is nnb.SliceModel:
+            return {'type': 'slice', 'slice': _index_spec(opts.get('slice'))}
+        if cls is nnb.CustomModel:
+            fn = opts.get('fn')
+            spec = {'type': 'custom', 'params': self.params(model.params)}
+            activation = _activation_spec(fn)
+            if activation is not None:
+                spec['activation'] = activation
+            else:
+                spec['fn'] = getattr(fn, '__name__', repr(fn))
+            return spec
+        if cls is nnb.PerceptronLayer or cls is nnb.DropoutLayer:
+            #The DropoutLayer is a PerceptronLayer at inference time
+            return {'type': 'perceptron', 'params': self.params(model.params),
+                    'activation': self.activation(model,
+                                                opts.get('activation_func'))}
+        if cls is nnb.SoftmaxLayer:
+            return {'type': 'softmax', 'params': self.params(model.params)}
+        if cls is nnb.SimpleRecurrence:
+            return {'type': 'simple_recurrence',
+                    'params': self.params(model.params),
+                    'activation': self.activation(model,
+                                                opts.get('activation_func'))}
+        if cls is nnb.LSTMRecurrence:
+            return {'type': 'lstm', 'params': self.params(model.params)}
+        if cls is nnb.RecurrentNeuralNetwork:
+            step = opts.get('model')
+            h0 = model.params[:len(model.params) - len(step.params)]
+            return {'type': 'recurrent', 'h0': self.params(h0),
+                    'model': self.node(step)}
+        if cls is nnb.RecursiveNeuralNetwork:
+            return {'type': 'recursive',
+                    'model': self.node(opts.get('comp_model'))}
+        if cls is nnb.ConvolutionalLayer:
+            return {'type': 'convolution', 'params': self.params(model.params),
+                    'stride': opts.get('stride'),
+                    'activation': self.activation(model,
+                                                opts.get('activation_func'))}
+        if cls is nnb.ConvolutionalBank:
+            return {'type': 'convolution_bank',
+                    'params': self.params(model.params),
+                    'stride': opts.get('stride'), 'pool': opts.get('pool'),
+                    'activation': self.activation(model,
+                                                opts.get('activation_func'))}
+        if cls is nnb.MaxPoolingLayer:
+            return {'type': 'max_pooling', 'window': opts.get('window'),
+                    'ignore_border': opts.get('ignore_border')}
+        if cls is nnb.MaxOverTimePoolingLayer:
+            return {'type': 'max_over_time'}
+        if cls is nnb.Model:
+            return {'type': 'identity'}
+        raise ValueError("Can't export Models of type {0}".format(cls.__name__))
+
+def _spec_of(model):
+    exporter = _Exporter(model)
+    spec = {
+        'format': _FORMAT,
+        'inputs': exporter.inputs,
+        'nodes': exporter.nodes,
+        'root': exporter.root
+    }
+    return spec, exporter.arrays
+
+def export(model, filename):
+    """Saves a Model to a file that can be read by load.
+    The Model is exported as compiled by model.compile(), i.e. in inference
+    mode.
+
+    :param model: The Model to be exported.
+    :param filename: The destination file.
+    """
+    spec, arrays = _spec_of(model)
+    save_arrays(filename, arrays, meta=spec)
+
+def load(filename, custom_fns=None, mmap_mode='r'):
+    """Reads a Model saved by export.
+
+    :param custom_fns: Optional dict from the names of the functions of the
+        exported CustomModels to NumPy functions that compute the same
+        outputs. These take the same parameters as the original functions,
+        with NumPy arrays in place of theano variables.
+    :param mmap_mode: Passed to nnb.utils.packed_arrays.load_arrays. By
+        default, the parameters are memory-mapped read-only, so processes
+        serving the same file share their memory.
+    :returns: A NumpyModel.
+    """
+    arrays, spec = load_arrays(filename, mmap_mode=mmap_mode)
+    if not isinstance(spec, dict) or spec.get('format') != _FORMAT:
+        raise ValueError("{0} isn't an exported Model".format(filename))
+    return NumpyModel(spec, arrays, custom_fns)
+
+def convert(model, custom_fns=None):
+    """Builds a NumpyModel for a Model without going through a file.
+    The parameters are copied, so training the Model further doesn't change
+    the NumpyModel.
+    """
+    spec, arrays = _spec_of(model)
+    arrays = dict((name, np.array(a)) for name, a in arrays)
+    return NumpyModel(spec, arrays, custom_fns)
+
+def _windows(x, window, stride):
+    """The rows of x seen by each step of a convolution, as a tensor of shape
+    (steps, window, dim)."""
+    steps = (len(x) - window) // stride + 1
+    if steps <= 0:
+        return np.zeros((0, window, x.shape[1]), dtype=x.dtype)
+    idx = np.arange(steps)[:, None] * stride + np.arange(window)[None, :]
+    return x[idx]
+
+def _convolution(x, W, b, stride, act):
+    #theano's conv2d flips the filters in both axes
+    W = W[:, ::-1, ::-1]
+    xw = _windows(x, W.shape[2], stride)
+    conv = np.tensordot(xw, W.transpose(0, 2, 1), axes=([1, 2], [1, 2]))
+    return act(conv + b)
+
+def _max_pooling(x, window, ignore_border):
+    axis = x.ndim - 2
+    length = x.shape[axis]
+    if ignore_border:
+        length = length // window * window
+        x = x[(slice(None),) * axis + (slice(0, length),)]
+    return np.maximum.reduceat(x, np.arange(0, length, window), axis=axis)
+
+class NumpyModel(object):
+    """A Model exported with nnb.utils.numpy_runtime.export, computed with
+    NumPy.
+    Calling a NumpyModel is the same as calling the function compiled by
+    model.compile(): it takes the user inputs in the same order and returns a
+    single array, if the Model has a single output, or a list of arrays.
+    """
+
+    def __init__(self, spec, arrays, custom_fns=None):
+        if custom_fns is None:
+            custom_fns = {}
+        self.inputs = spec['inputs']
+        self._root = spec['root']
+        self._nodes = []
+        for node in spec['nodes']:
+            node = dict(node)
+            node['params'] = [arrays[name] for name in node.get('params', [])]
+            if 'h0' in node:
+                node['h0'] = [arrays[name] for name in node['h0']]
+            if 'activation' in node:
+                kwargs = dict(node['activation'])
+                fn = activations[kwargs.pop('name')]
+                if len(kwargs) > 0:
+                    fn = self._bind(fn, kwargs)
+                node['activation'] = fn
+            if node['type'] == 'custom' and 'activation' not in node:
+                if node['fn'] not in custom_fns:
+                    raise ValueError(("The NumPy version of the CustomModel " +
+                                    "function '{0}' should be given in " +
+                                    "custom_fns").format(node['fn']))
+                node['fn'] = custom_fns[node['fn']]
+            if node['type'] == 'slice':
+                node['slice'] = _index_value(node['slice'])
+            self._nodes.append(node)
+
+    @staticmethod
+    def _bind(fn, kwargs):
+        return lambda a: fn(a, **kwargs)
+
+    def __call__(self, *inputs):
+        if len(inputs) != len(self.inputs):
+            raise TypeError("Expected {0} inputs, got {1}".format(
+                                len(self.inputs), len(inputs)))
+        inputs = [np.asarray(x, dtype=inp['dtype'])
+                    for x, inp in zip(inputs, self.inputs)]
+        outputs = self._apply(self._root, None, inputs, {})
+        if len(outputs) == 1:
+            return outputs[0]
+        return outputs
+
+    def _apply(self, index, prev, inputs, memo):
+        """Mirrors nnb.model.apply_model: a node applied twice to the same
+        inputs is computed once."""
+        if prev is None:
+            key = (index, None)
+        else:
+            key = (index,) + tuple(id(p) for p in prev)
+        if key in memo:
+            return list(memo[key][1])
+        node = self._nodes[index]
+        out = getattr(self, '_' + node['type'])(node, prev, inputs, memo)
+        memo[key] = (prev, out)
+        return out
+
+    def _horizontal(self, node, prev, inputs, memo):
+        out = prev
+        for index in node['models']:
+            out = self._apply(index, out, inputs, memo)
+        return out
+
+    def _vertical(self, node, prev, inputs, memo):
+        outs = []
+        for index in node['models']:
+            outs += self._apply(index, prev, inputs, memo)
+        return outs
+
+    def _input(self, node, prev, inputs, memo):
+        if prev is None:
+            prev = []
+        return [inputs[node['input']]] + prev
+
+    def _identity(self, node, prev, inputs, memo):
+        return prev
+
+    def _picker(self, node, prev, inputs, memo):
+        return [node['params'][0][prev[0]]]
+
+    def _concatenation(self, node, prev, inputs, memo):
+        return [np.concatenate(prev, axis=node['axis'])]
+
+    def _slice(self, node, prev, inputs, memo):
+        sli = node['slice']
+        if len(prev) == 1:
+            return [prev[0][sli]]
+        if isinstance(sli, list):
+            return [prev[index] for index in sli]
+        if isinstance(sli, (int, long)):
+            return [prev[sli]]
+        return prev[sli]
+
+    def _custom(self, node, prev, inputs, memo):
+        if 'activation' in node:
+            return [node['activation'](*(prev + node['params']))]
+        o = node['fn'](*(prev + node['params']))
+        if isinstance(o, tuple):
+            return list(o)
+        if not isinstance(o, list):
+            return [o]
+        return o
+
+    def _perceptron(self, node, prev, inputs, memo):
+        W, b = node['params']
+        return [node['activation'](prev[0].dot(W) + b)]
+
+    def _softmax(self, node, prev, inputs, memo):
+        W, b = node['params']
+        return [_softmax(prev[0].dot(W) + b)]
+
+    def _simple_recurrence(self, node, prev, inputs, memo):
+        W, b, W_h = node['params']
+        x_t, h_tm1 = prev[:2]
+        return [node['activation'](x_t.dot(W) + b + h_tm1.dot(W_h))]
+
+    def _lstm(self, node, prev, inputs, memo):
+        Wi, Wf, Wc, Wo, Ui, Uf, Uc, Uo, Vo, bi, bf, bc, bo = node['params']
+        x_t, h_tm1, C_tm1 = prev[:3]
+        it = _sigmoid(x_t.dot(Wi) + h_tm1.dot(Ui) + bi)
+        _Ct = np.tanh(x_t.dot(Wc) + h_tm1.dot(Uc) + bc)
+        ft = _sigmoid(x_t.dot(Wf) + h_tm1.dot(Uf) + bf)
+        Ct = it * _Ct + ft * C_tm1
+        ot = _sigmoid(x_t.dot(Wo) + Ct.dot(Vo) + h_tm1.dot(Uo) + bo)
+        return [ot * np.tanh(Ct), Ct]
+
+    def _recurrent(self, node, prev, inputs, memo):
+        h = list(node['h0'])
+        steps = [[] for _ in h]
+        for t in xrange(len(prev[0])):
+            #Each step has its own memo, like each step of theano's scan
+            h = self._apply(node['model'], [x[t] for x in prev] + h, inputs,
+                            {})
+            for step, o in zip(steps, h):
+                step.append(o)
+        return [np.asarray(s) if len(s) > 0 else
+                np.zeros((0,) + h0.shape, dtype=h0.dtype)
+                for s, h0 in zip(steps, node['h0'])]
+
+    def _recursive(self, node, prev, inputs, memo):
+        comp_tree = prev[0]
+        x = prev[1:]
+        leafs_nr = len(x[0])
+        partials = []
+        for o in x:
+            partial = np.zeros((len(o) + len(comp_tree),) + o.shape[1:],
+                                dtype=o.dtype)
+            partial[:len(o)] = o
+            partials.append(partial)
+
+        for i, children in enumerate(comp_tree):
+            inputs1 = [p[children[0]] for p in partials]
+            inputs2 = [p[children[1]] for p in partials]
+            out = self._apply(node['model'], inputs1 + inputs2, inputs, {})
+            for p, o in zip(partials, out):
+                p[leafs_nr + i] = o
+
+        return partials
+
+    def _convolution(self, node, prev, inputs, memo):
+        W, b = node['params']
+        return [_convolution(prev[0], W, b, node['stride'],
+                            node['activation'])]
+
+    def _convolution_bank(self, node, prev, inputs, memo):
+        params = node['params']
+        Ws = params[:len(params) // 2]
+        bs = params[len(params) // 2:]
+        outputs = []
+        for W, b in zip(Ws, bs):
+            o = _convolution(prev[0], W, b, node['stride'], node['activation'])
+            if node['pool']:
+                o = o.max(axis=0)
+            outputs.append(o)
+        return outputs
+
+    def _max_pooling(self, node, prev, inputs, memo):
+        return [_max_pooling(prev[0], node['window'], node['ignore_border'])]
+
+    def _max_over_time(self, node, prev, inputs, memo):
+        x = prev[0]
+        if len(prev) > 1:
+            mask = np.asarray(prev[1])[..., None]
+            x = np.where(mask, x, -np.inf)
+        return [x.max(axis=x.ndim - 2)]
@@ -138,6 +138,15 @@ class Options(object):
         #Just let the KeyError propagate if the option doesn't exist
         return self.__ops[name]
 
+    def names(self):
+        """Gets the names of all options.
+
+        Returns:
+            A sorted list with the options' names.
+
+        """
+        return sorted(self.__ops)
+
     def check(self):
         """Runs all the validation checks specified in the options.
         If the check fails, a ValueError will be raised.
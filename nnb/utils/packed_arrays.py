@@ -0,0 +1,104 @@
+# NNBlocks is a Deep Learning framework for computational linguistics.
+#
+#   Copyright (C) 2015 Frederico Tommasi Caroli
+#
+#   NNBlocks is free software: you can redistribute it and/or modify it under
+#   the terms of the GNU General Public License as published by the Free
+#   Software Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   NNBlocks is distributed in the hope that it will be useful, but WITHOUT ANY
+#   WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+#   FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+#   details.
+#
+#   You should have received a copy of the GNU General Public License along with
+#   NNBlocks. If not, see http://www.gnu.org/licenses/.
+
+"""A single file format for named NumPy arrays that can be memory-mapped.
+The file starts with a magic string, the length of a JSON header and the
+header itself. The header has the dtype, shape and offset of every array and
+any JSON metadata given to save_arrays. The data of each array follows,
+aligned to _ALIGNMENT bytes, so every array can be memory-mapped in place.
+"""
+import os
+import json
+import struct
+import numpy as np
+
+_MAGIC = 'NNBPACK1'
+_ALIGNMENT = 64
+
+def _align(n):
+    return (n + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+def save_arrays(filename, arrays, meta=None):
+    """Saves named arrays to a single file.
+    The file is first written next to its destination and then renamed, so a
+    reader never sees a half written file.
+
+    :param arrays: A dict or a list of (name, array) tuples.
+    :param meta: Optional JSON serializable object stored with the arrays.
+    """
+    if isinstance(arrays, dict):
+        arrays = sorted(arrays.items())
+    #ascontiguousarray turns scalars into arrays of shape (1,)
+    arrays = [(name, np.ascontiguousarray(a).reshape(np.shape(a)))
+                for name, a in arrays]
+
+    entries = {}
+    offset = 0
+    for name, a in arrays:
+        entries[name] = {
+            'dtype': a.dtype.str,
+            'shape': list(a.shape),
+            'offset': offset
+        }
+        offset = _align(offset + a.nbytes)
+    header = json.dumps({'arrays': entries, 'meta': meta})
+    data_start = _align(len(_MAGIC) + 8 + len(header))
+
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as fout:
+        fout.write(_MAGIC)
+        fout.write(struct.pack('<Q', len(header)))
+        fout.write(header)
+        for name, a in arrays:
+            fout.seek(data_start + entries[name]['offset'])
+            fout.write(a.data)
+        fout.truncate(data_start + offset)
+    os.rename(tmp_filename, filename)
+
+def load_arrays(filename, mmap_mode='r'):
+    """Loads the arrays saved by save_arrays.
+
+    :param mmap_mode: The mode used to memory-map the arrays (see
+        numpy.memmap). Default is 'r'. Set it to None to read the arrays into
+        memory.
+    :returns: A tuple with a dict of arrays and the metadata
+    """
+    with open(filename, 'rb') as fin:
+        if fin.read(len(_MAGIC)) != _MAGIC:
+            raise ValueError("{0} is not a packed arrays file".format(filename))
+        header_len, = struct.unpack('<Q', fin.read(8))
+        header = json.loads(fin.read(header_len))
+        data_start = _align(len(_MAGIC) + 8 + header_len)
+
+        arrays = {}
+        for name, entry in header['arrays'].iteritems():
+            name = str(name)
+            dtype = np.dtype(str(entry['dtype']))
+            shape = tuple(entry['shape'])
+            offset = data_start + entry['offset']
+            #memmap can't map empty arrays and gives scalars the shape (1,)
+            if mmap_mode is not None and len(shape) > 0 and \
+                    np.prod(shape) > 0:
+                arrays[name] = np.memmap(fin, dtype=dtype, mode=mmap_mode,
+                                        offset=offset, shape=shape)
+            else:
+                fin.seek(offset)
+                count = int(np.prod(shape))
+                arrays[name] = np.fromfile(fin, dtype=dtype, count=count) \
+                                .reshape(shape)
+
+    return arrays, header['meta']
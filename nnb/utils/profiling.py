@@ -0,0 +1,296 @@
+# NNBlocks is a Deep Learning framework for computational linguistics.
+#
+#   Copyright (C) 2015 Frederico Tommasi Caroli
+#
+#   NNBlocks is free software: you can redistribute it and/or modify it under
+#   the terms of the GNU General Public License as published by the Free
+#   Software Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   NNBlocks is distributed in the hope that it will be useful, but WITHOUT ANY
+#   WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+#   FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+#   details.
+#
+#   You should have received a copy of the GNU General Public License along with
+#   NNBlocks. If not, see http://www.gnu.org/licenses/.
+
+"""Profiling of Models block by block.
+Theano's profiler reports the time spent in each op of a compiled function,
+which says little about the Model that built it. A BlockProfiler compiles a
+Model with every variable tagged with the Model that computed it, runs it with
+Theano's profiler and adds the time and memory of the ops up by Model,
+including the ops inside the scans of recurrent Models:
+
+    profiler = BlockProfiler(model)
+    for x in data:
+        profiler(x)
+    profiler.summary()
+
+The Models are named by their paths in the Model tree, like in
+nnb.utils.checkpoint: the second Model of `a | b` is 'models.1'.
+"""
+import sys
+import contextlib
+import theano
+import theano.compile.profiling as theano_profiling
+from theano.compile.profiling import ProfileStats
+from theano.scan_module.scan_op import Scan
+from theano.compile.function_module import std_fgraph
+from theano.gof.toolbox import Feature
+import numpy as np
+from checkpoint import model_paths
+
+UNTRACKED = '<untracked>'
+
+def _block(var):
+    return getattr(var.tag, 'nnb_block', None)
+
+class _TagPropagation(Feature):
+    """Tags the variables that the graph optimizations put in place of tagged
+    ones, including the ones of the inner functions of the scans"""
+
+    def __init__(self, profiler):
+        self.profiler = profiler
+
+    def on_change_input(self, fgraph, node, i, r, new_r, reason=None):
+        block = _block(r)
+        if block is None:
+            return
+        old = _block(new_r)
+        if old is not None and old != block:
+            #The ops of two Models were merged
+            new_r.tag.nnb_block = self.profiler._common_block([old, block])
+            return
+        self.profiler._tag_graph([new_r], block, fgraph.inputs)
+
+@contextlib.contextmanager
+def _profiling(memory):
+    #The scans only profile their inner functions if the profiling is on
+    #while they are compiled, and the virtual machines that record the
+    #memory only time the ops while it is on
+    old_profile = theano.config.profile
+    old_memory = theano.config.profile_memory
+    theano.config.profile = True
+    theano.config.profile_memory = memory
+    try:
+        yield
+    finally:
+        theano.config.profile = old_profile
+        theano.config.profile_memory = old_memory
+
+def _nbytes(var, shape):
+    dtype = getattr(var.type, 'dtype', None)
+    if dtype is None or not isinstance(shape, (tuple, list)):
+        return 0
+    return int(np.prod(shape)) * np.dtype(dtype).itemsize
+
+class BlockProfiler(object):
+    """Compiles a Model to be profiled block by block.
+    Calls to the profiler are calls to the compiled function. The time of an
+    op is given to the Model that built it. When graph optimizations merge the
+    ops of several Models, the time goes to the innermost Model that holds all
+    of them. The ops that no Model built, like the copies of the outputs, are
+    reported as '<untracked>'.
+
+    :param model: The Model to be profiled.
+    :param train: If True, the graph is built in training mode. See
+        nnb.model.is_training. Default is False
+    :param memory: If True, the memory of the outputs of each op is also
+        recorded. Default is True
+    :param **kwargs: Every key=value parameter will be passed along to the
+        `theano.function` compiler.
+    """
+
+    def __init__(self, model, train=False, memory=True, **kwargs):
+        import nnb.model
+        self.model = model
+        self._models = model_paths(model)
+        self._paths = dict((id(m), path) for path, m in self._models)
+        self._parents = self._build_tree()
+
+        old_hook = nnb.model._apply_hook
+        nnb.model._apply_hook = self._hook
+        try:
+            inputs, outputs, updates = model.get_io(train=train)
+        finally:
+            nnb.model._apply_hook = old_hook
+
+        self.memory = memory
+        self.profile = ProfileStats(atexit_print=False,
+                                    name='BlockProfiler')
+        #The profiles of the scans are not printed at exit
+        n_atexit = len(theano_profiling._atexit_print_list)
+        feature = _TagPropagation(self)
+        make_feature = lambda: feature
+        std_fgraph.features.append(make_feature)
+        try:
+            with _profiling(memory):
+                self._fn = theano.function(inputs, outputs, updates=updates,
+                                            profile=self.profile, **kwargs)
+        finally:
+            std_fgraph.features.remove(make_feature)
+            del theano_profiling._atexit_print_list[n_atexit:]
+
+    def _build_tree(self):
+        paths = [path for path, m in self._models]
+        parents = {}
+        for path in paths:
+            if path == '':
+                continue
+            parent = ''
+            for other in paths:
+                if (len(other) > len(parent) and
+                        path.startswith(other + '.') and other != path):
+                    parent = other
+            parents[path] = parent
+        parents[UNTRACKED] = ''
+        return parents
+
+    def _hook(self, model, prev, out):
+        path = self._paths.get(id(model))
+        if path is None:
+            return
+        outputs = out
+        if isinstance(out, tuple):
+            outputs = list(out[0]) + list(out[1].values())
+        outputs = [o for o in outputs if isinstance(o, theano.Variable)]
+        #Inner Models were applied first, so their variables are left alone
+        self._tag_graph(outputs, path, prev or [], stop_tagged=False)
+
+    def _tag_graph(self, outputs, path, stop, stop_tagged=True):
+        """Tags the untagged variables computed from stop to the outputs"""
+        stop = set(stop)
+        todo = list(outputs)
+        seen = set()
+        while len(todo) > 0:
+            var = todo.pop()
+            if var in seen or var in stop or var.owner is None:
+                continue
+            seen.add(var)
+            if stop_tagged and _block(var) is not None:
+                continue
+            for o in var.owner.outputs:
+                if _block(o) is None:
+                    o.tag.nnb_block = path
+            todo.extend(var.owner.inputs)
+
+    def _ancestors(self, path):
+        chain = [path]
+        while path in self._parents:
+            path = self._parents[path]
+            chain.append(path)
+        return chain
+
+    def _common_block(self, blocks):
+        blocks = [b for b in blocks if b == '' or b in self._parents]
+        if len(blocks) == 0:
+            return UNTRACKED
+        common = self._ancestors(blocks[0])
+        for block in blocks[1:]:
+            ancestors = set(self._ancestors(block))
+            common = [b for b in common if b in ancestors]
+        return common[0]
+
+    def _node_block(self, node, default=UNTRACKED):
+        blocks = set(_block(o) for o in node.outputs)
+        blocks.discard(None)
+        block = self._common_block(list(blocks))
+        return default if block == UNTRACKED else block
+
+    def __call__(self, *inputs, **kwargs):
+        with _profiling(self.memory):
+            return self._fn(*inputs, **kwargs)
+
+    def _add(self, profile, stats, default=UNTRACKED):
+        for node, t in profile.apply_time.items():
+            block = self._node_block(node, default)
+            inner = getattr(getattr(node.op, 'fn', None), 'profile', None)
+            if isinstance(node.op, Scan) and isinstance(inner, ProfileStats):
+                #The scan itself only takes the time its inner ops don't.
+                #The inner ops that lost their tags belong to the scan.
+                t = max(t - sum(inner.apply_time.values()), 0.)
+                self._add(inner, stats, block)
+            s = stats[block]
+            s['self_time'] += t
+            s['ops'] += 1
+            for o in node.outputs:
+                if o in profile.variable_shape:
+                    s['self_memory'] += _nbytes(o, profile.variable_shape[o])
+
+    def stats(self):
+        """Adds up the profile of the calls so far by Model.
+
+        :returns: A dict from Model paths to dicts with the class name of the
+            Model ('model'), the time, in seconds, spent in its own ops
+            ('self_time') and in the ops of its whole subtree ('time'), the
+            number of its own ops ('ops') and the bytes of the outputs of its
+            own ops and of its subtree's ops in the last call ('self_memory'
+            and 'memory'). The ops inside scans are counted once per scan.
+        """
+        stats = {}
+        for path in [p for p, m in self._models] + [UNTRACKED]:
+            stats[path] = {'self_time': 0., 'ops': 0, 'self_memory': 0}
+        for path, m in self._models:
+            stats[path]['model'] = m.__class__.__name__
+        stats[UNTRACKED]['model'] = ''
+        self._add(self.profile, stats)
+
+        for path, s in stats.items():
+            s['time'] = s['self_time']
+            s['memory'] = s['self_memory']
+        for path, s in stats.items():
+            for ancestor in self._ancestors(path)[1:]:
+                stats[ancestor]['time'] += s['self_time']
+                stats[ancestor]['memory'] += s['self_memory']
+        if stats[UNTRACKED]['ops'] == 0:
+            del stats[UNTRACKED]
+        return stats
+
+    def _children(self, stats):
+        children = dict((path, []) for path in stats)
+        for path in stats:
+            if path != '':
+                children[self._parents[path]].append(path)
+        return children
+
+    def summary(self, file=sys.stdout):
+        """Prints the stats as a tree that mirrors the Model tree."""
+        stats = self.stats()
+        children = self._children(stats)
+        total = stats['']['time']
+        print >> file, 'Block profile of {0} calls ({1:.3f}s in ops)'.format(
+            self.profile.fct_callcount, total)
+        print >> file, '{0:<50} {1:>10} {2:>7} {3:>10} {4:>10} {5:>5}'.format(
+            'Block', 'Time (s)', '%', 'Self (s)', 'Memory', 'Ops')
+
+        def show(path, depth):
+            s = stats[path]
+            name = path.split('.')[-1] if path != '' else '(model)'
+            if path != '' and path != UNTRACKED:
+                #Lists, like the models of a join, show their option names
+                parent = self._parents[path]
+                name = path[len(parent) + 1:] if parent != '' else path
+            label = '  ' * depth + name
+            if s['model'] != '':
+                label += ' ' + s['model']
+            percent = 100. * s['time'] / total if total > 0 else 0.
+            print >> file, ('{0:<50} {1:>10.5f} {2:>6.1f}% {3:>10.5f} ' +
+                            '{4:>10} {5:>5}').format(label, s['time'],
+                            percent, s['self_time'],
+                            _format_bytes(s['memory']), s['ops'])
+            for child in sorted(children[path], key=_path_key):
+                show(child, depth + 1)
+
+        show('', 0)
+
+def _path_key(path):
+    return [int(p) if p.isdigit() else p for p in path.split('.')]
+
+def _format_bytes(n):
+    if n < 1024:
+        return '{0}B'.format(n)
+    for unit in ['KB', 'MB', 'GB']:
+        n /= 1024.
+        if n < 1024 or unit == 'GB':
+            return '{0:.1f}{1}'.format(n, unit)
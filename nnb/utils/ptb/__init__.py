@@ -16,4 +16,6 @@
 #   NNBlocks. If not, see http://www.gnu.org/licenses/.
 
 from nnb.utils.ptb.ptb_tree import PTBTreeNode
-from nnb.utils.ptb.ptb_parser import PTBParser
+from nnb.utils.ptb.ptb_parser import PTBParser, FastPTBParser, parse_tree
+from nnb.utils.ptb.ptb_reader import read_trees, read_trees_parallel
+from nnb.utils.ptb.ptb_dataset import compile_treebank, TreebankDataset
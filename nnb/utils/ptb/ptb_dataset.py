@@ -0,0 +1,110 @@
+# NNBlocks is a Deep Learning framework for computational linguistics.
+#
+#   Copyright (C) 2015 Frederico Tommasi Caroli
+#
+#   NNBlocks is free software: you can redistribute it and/or modify it under
+#   the terms of the GNU General Public License as published by the Free
+#   Software Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   NNBlocks is distributed in the hope that it will be useful, but WITHOUT ANY
+#   WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+#   FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+#   details.
+#
+#   You should have received a copy of the GNU General Public License along with
+#   NNBlocks. If not, see http://www.gnu.org/licenses/.
+
+"""Compile-once binary cache of a treebank's features.
+A treebank is compiled with compile_treebank into a single packed arrays file
+(see nnb.utils.packed_arrays) and loaded back with TreebankDataset, which
+memory-maps the file and hands out per-sentence views.
+"""
+import numpy as np
+from nnb.utils.packed_arrays import save_arrays, load_arrays
+from nnb.utils.ptb.ptb_reader import read_trees
+
+_FIELDS = ['sentences', 'comp_trees', 'labels']
+
+def compile_treebank(trees, filename, translate, label_fn=int, plain=True):
+    """Extracts the features of every tree and saves them to a file.
+    Each feature is stored as a ragged array: the values of all sentences
+    concatenated, and an int64 offsets array with one more entry than the
+    number of sentences.
+
+    :param trees: A file name, a list of file names or an iterable of
+        PTBTreeNode.
+    :param filename: The file to write.
+    :param translate: Callable that maps a word to its index, like
+        WordVecsHelper.translate_word.
+    :param label_fn: Callable that maps a node label to an int. Default is
+        int.
+    :param plain: If True and trees are read from files, PTBTreeNode.plain is
+        called on each tree. Default is True.
+    :returns: The number of sentences compiled
+    """
+    if isinstance(trees, basestring) or \
+            (isinstance(trees, list) and len(trees) > 0 and
+            isinstance(trees[0], basestring)):
+        trees = read_trees(trees, plain=plain)
+
+    values = dict((field, []) for field in _FIELDS)
+    lengths = dict((field, [0]) for field in _FIELDS)
+    for tree in trees:
+        features = tree.get_features_arrays(translate=translate,
+                                            label_fn=label_fn)
+        for field, feature in zip(_FIELDS, features):
+            values[field].append(feature)
+            lengths[field].append(len(feature))
+
+    arrays = []
+    for field in _FIELDS:
+        if len(values[field]) > 0:
+            data = np.concatenate(values[field])
+        elif field == 'comp_trees':
+            data = np.zeros((0, 2), dtype='int32')
+        else:
+            data = np.zeros((0,), dtype='int32')
+        arrays.append((field, data))
+        arrays.append((field + '_offsets',
+                        np.cumsum(lengths[field], dtype='int64')))
+    save_arrays(filename, arrays, meta={'format': 'treebank'})
+
+    return len(lengths['sentences']) - 1
+
+class TreebankDataset:
+    """A treebank compiled with compile_treebank.
+    The file is memory-mapped, so loading is almost instant and the pages are
+    shared between processes. Indexing returns a tuple (sentence, comp_tree,
+    labels) of views into the file, in the format of
+    PTBTreeNode.get_features_arrays.
+    """
+
+    def __init__(self, filename, mmap_mode='r'):
+        """
+        :param mmap_mode: The mode used to memory-map the file (see
+            numpy.memmap). Set it to None to read the whole file into memory.
+        """
+        arrays, meta = load_arrays(filename, mmap_mode=mmap_mode)
+        if meta is None or meta.get('format') != 'treebank':
+            raise ValueError("{0} is not a compiled treebank".format(filename))
+        self.values = [arrays[field] for field in _FIELDS]
+        #The offsets are small and read on every access, so they are copied
+        #to memory instead of being read from the memory map
+        self.offsets = [np.array(arrays[field + '_offsets'], copy=True)
+                        for field in _FIELDS]
+
+    def __len__(self):
+        return len(self.offsets[0]) - 1
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("Sentence index out of range")
+        return tuple(v[o[index]:o[index + 1]]
+                    for v, o in zip(self.values, self.offsets))
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
@@ -15,6 +15,8 @@
 #   You should have received a copy of the GNU General Public License along with
 #   NNBlocks. If not, see http://www.gnu.org/licenses/.
 
+import re
+import itertools
 from nnb.utils.ptb import PTBTreeNode
 
 class PTBTokenizer:
@@ -98,3 +100,66 @@ class PTBParser:
                 return PTBTreeNode(label,value)
             token = self.t.next_token()
 
+
+_TOKEN_RE = re.compile(r'[()]|[^() \n]+')
+
+def parse_tree(string):
+    """Parses a tree in the Penn Treebank format.
+    Builds the same PTBTreeNode tree as PTBParser.parse, but the string is
+    tokenized with a single regular expression and the tree is built with an
+    explicit stack, so deep trees don't hit the recursion limit.
+    Returns None if the string doesn't have a complete tree.
+    """
+    tokens = _TOKEN_RE.findall(string.strip())
+    #The open node is kept in locals and its ancestors in the stack
+    label = None
+    label_read = False
+    value = None
+    stack = []
+    push = stack.append
+    pop = stack.pop
+    for token in itertools.islice(tokens, 1, None):
+        if token == '(':
+            push((label, label_read, value))
+            label = None
+            label_read = False
+            value = None
+        elif token == ')':
+            node = PTBTreeNode(label, value)
+            if not stack:
+                return node
+            label, label_read, value = pop()
+            if value is None:
+                value = [node]
+            else:
+                value += [node]
+        elif not label_read:
+            label = token
+            label_read = True
+        else:
+            value = token
+    return None
+
+class FastPTBParser:
+    """Drop-in replacement for PTBParser that uses parse_tree.
+    Reads one tree per line when instantiated with a file name.
+    """
+    def __init__(self, filename=None):
+        self.read_file = None
+        if filename is not None:
+            self.read_file = open(filename,'r')
+
+    def __del__(self):
+        if self.read_file is not None:
+            self.read_file.close()
+
+    def parse(self, string=None):
+        if string is None:
+            if self.read_file is None:
+                raise ValueError(
+                    'Parser instantiated without a file name. Either ' + \
+                    'specify a string to parse with the "string" parameter' + \
+                    ' or instantiate a Parser with the "filename" parameter'
+                )
+            string = self.read_file.readline()
+        return parse_tree(string)
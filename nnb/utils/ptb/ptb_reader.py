@@ -0,0 +1,121 @@
+# NNBlocks is a Deep Learning framework for computational linguistics.
+#
+#   Copyright (C) 2015 Frederico Tommasi Caroli
+#
+#   NNBlocks is free software: you can redistribute it and/or modify it under
+#   the terms of the GNU General Public License as published by the Free
+#   Software Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   NNBlocks is distributed in the hope that it will be useful, but WITHOUT ANY
+#   WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+#   FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+#   details.
+#
+#   You should have received a copy of the GNU General Public License along with
+#   NNBlocks. If not, see http://www.gnu.org/licenses/.
+
+"""Streaming readers for treebanks with one tree per line.
+Files ending in .gz are read with gzip. Blank lines are skipped.
+"""
+import gzip
+import itertools
+import collections
+import multiprocessing
+from nnb.utils.ptb.ptb_parser import parse_tree
+
+_CHUNK_LINES = 10000
+
+def _open(filename):
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    return open(filename, 'r')
+
+def _read_lines(filenames):
+    """Yields the (filename, line number, line) of the non blank lines"""
+    if isinstance(filenames, basestring):
+        filenames = [filenames]
+    for filename in filenames:
+        with _open(filename) as f:
+            for i, line in enumerate(f):
+                if line.strip():
+                    yield filename, i + 1, line
+
+def _process_line(filename, line_number, line, plain, features):
+    tree = parse_tree(line)
+    if tree is None:
+        raise ValueError("Line {0} of {1} doesn't have a complete tree"
+                        .format(line_number, filename))
+    if plain:
+        tree.plain()
+    if features:
+        return tree.get_features_arrays()
+    return tree
+
+def _process_chunk(args):
+    lines, plain, features = args
+    return [_process_line(filename, line_number, line, plain, features)
+            for filename, line_number, line in lines]
+
+def read_trees(filenames, plain=False, features=False):
+    """Lazily reads the trees of one or many treebank files.
+
+    :param filenames: A file name or a list of file names. The files are read
+        in order and only one of them is open at a time.
+    :param plain: If True, PTBTreeNode.plain is called on each tree.
+    :param features: If True, the features of each tree, as returned by
+        PTBTreeNode.get_features_arrays, are yielded instead of the tree.
+    Raises a ValueError with the line number if a line doesn't have a complete
+    tree.
+    """
+    for filename, line_number, line in _read_lines(filenames):
+        yield _process_line(filename, line_number, line, plain, features)
+
+def read_trees_parallel(filenames, processes=None, plain=False,
+                        features=False, chunk_lines=_CHUNK_LINES):
+    """Reads treebank files with a pool of worker processes.
+    The lines are read in the calling process and sent in chunks to the
+    workers, which parse them and send back the trees or, with
+    features=True, their features. Features are much cheaper to send between
+    processes than trees, so prefer them when the trees aren't needed.
+    Everything is yielded in corpus order and only a few chunks per worker are
+    in flight at a time, so memory doesn't grow with the size of the corpus.
+
+    :param filenames: A file name or a list of file names.
+    :param processes: The number of worker processes. Default is the number of
+        CPUs. If set to 1, no worker process is started.
+    :param plain: If True, PTBTreeNode.plain is called on each tree.
+    :param features: If True, the features of each tree, as returned by
+        PTBTreeNode.get_features_arrays, are yielded instead of the tree.
+    :param chunk_lines: The number of lines sent to a worker at a time.
+    Raises a ValueError with the line number if a line doesn't have a complete
+    tree.
+    """
+    lines = _read_lines(filenames)
+    chunks = iter(lambda: list(itertools.islice(lines, chunk_lines)), [])
+    args = ((chunk, plain, features) for chunk in chunks)
+
+    if processes == 1:
+        for results in itertools.imap(_process_chunk, args):
+            for result in results:
+                yield result
+        return
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(processes=processes)
+    try:
+        in_flight = collections.deque()
+        max_in_flight = 2 * processes
+        for arg in args:
+            in_flight.append(pool.apply_async(_process_chunk, (arg,)))
+            if len(in_flight) < max_in_flight:
+                continue
+            for result in in_flight.popleft().get():
+                yield result
+        while in_flight:
+            for result in in_flight.popleft().get():
+                yield result
+    finally:
+        pool.terminate()
+        pool.join()
@@ -79,6 +79,67 @@ class PTBTreeNode:
                 leafs_labels + internal_labels + [self.label])
                 
 
+    def get_features_arrays(self, translate=None, label_fn=int):
+        """Extracts the same features as get_features into int32 arrays.
+        The tree is walked twice without recursion, once to number the nodes
+        in post order and once to fill preallocated arrays, so this runs in
+        linear time for trees of any depth. The node ids are the same ones
+        get_features gives and the ones RecursiveNeuralNetwork expects.
+
+        :param translate: Optional callable that maps a word to its index, like
+            WordVecsHelper.translate_word. If it isn't set, the sentence is
+            returned as a list of string tokens.
+        :param label_fn: Callable that maps a node label to an int. Default is
+            int.
+        :returns: A tuple (sentence, comp_tree, labels) where comp_tree is an
+            int32 matrix of shape (leafs_nr - 1, 2) and labels is an int32
+            vector of length 2 * leafs_nr - 1.
+        """
+        #First pass: the nodes in post order
+        post_order = []
+        leafs_nr = 0
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            post_order.append(node)
+            if isinstance(node.value, str):
+                leafs_nr += 1
+            elif len(node.value) != 2:
+                raise ValueError("get_features_arrays only works with " +
+                                "binary trees. Found a node with {0} children."
+                                .format(len(node.value)))
+            else:
+                stack.extend(node.value)
+        post_order.reverse()
+
+        #Second pass: number the nodes and fill the arrays
+        if translate is None:
+            sentence = [None] * leafs_nr
+        else:
+            sentence = np.empty(leafs_nr, dtype='int32')
+        comp_tree = np.empty((leafs_nr - 1, 2), dtype='int32')
+        labels = np.empty(2 * leafs_nr - 1, dtype='int32')
+        next_leaf = 0
+        next_internal = leafs_nr
+        ids = []
+        for node in post_order:
+            if isinstance(node.value, str):
+                node_id = next_leaf
+                next_leaf += 1
+                if translate is None:
+                    sentence[node_id] = node.value
+                else:
+                    sentence[node_id] = translate(node.value)
+            else:
+                node_id = next_internal
+                next_internal += 1
+                right = ids.pop()
+                comp_tree[node_id - leafs_nr] = (ids.pop(), right)
+            labels[node_id] = label_fn(node.label)
+            ids.append(node_id)
+
+        return (sentence, comp_tree, labels)
+
     def penn_print(self, tabs=0):
         if isinstance(self.value, str):
             print ("\t"*tabs) + "(" + self.label + " " + self.value + ")"
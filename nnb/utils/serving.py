@@ -0,0 +1,411 @@
+# NNBlocks is a Deep Learning framework for computational linguistics.
+#
+#   Copyright (C) 2015 Frederico Tommasi Caroli
+#
+#   NNBlocks is free software: you can redistribute it and/or modify it under
+#   the terms of the GNU General Public License as published by the Free
+#   Software Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   NNBlocks is distributed in the hope that it will be useful, but WITHOUT ANY
+#   WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+#   FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+#   details.
+#
+#   You should have received a copy of the GNU General Public License along with
+#   NNBlocks. If not, see http://www.gnu.org/licenses/.
+
+"""Serving of compiled Models.
+A MicroBatcher takes requests from many threads, groups them into batches and
+computes each batch with a single call on a single thread. An HTTP server,
+over TCP or a Unix socket, feeds a MicroBatcher with JSON requests:
+
+    #The InputLayer has one more dimension than a request, for the batch
+    f = model.compile()
+    batcher = MicroBatcher(f, max_batch_size=32, max_latency=0.005)
+    server = make_server(batcher, port=8000)
+    server.serve_forever()
+
+    #POST /predict with {"inputs": [[1, 6, 12, 7]]} answers
+    #{"outputs": [...]}. GET /stats answers the batcher's metrics.
+
+The JSON inputs are given to the function as lists, so theano functions with
+float32 inputs should be compiled with allow_input_downcast=True.
+"""
+import sys
+import json
+import time
+import Queue
+import threading
+import collections
+import SocketServer
+import BaseHTTPServer
+import numpy as np
+
+class ServerBusy(Exception):
+    """Raised when a MicroBatcher has too many pending requests"""
+    pass
+
+class _Request(object):
+
+    def __init__(self, inputs):
+        self.inputs = inputs
+        self.arrival = time.time()
+        self.result = None
+        self.error = None
+        self.abandoned = False
+        self._done = threading.Event()
+
+    def set_result(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self._done.set()
+
+    def wait(self, timeout=None):
+        """Waits for the result and returns it. Exceptions raised while
+        computing the request are raised again here. A request that times out
+        is abandoned: it is dropped if it wasn't computed yet."""
+        if not self._done.wait(timeout):
+            self.abandoned = True
+            raise ServerBusy("The request timed out")
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.result
+
+def _input_ndims(fn):
+    """The number of dimensions of the inputs of a theano function, or None
+    for other functions"""
+    maker = getattr(fn, 'maker', None)
+    if maker is None:
+        return None
+    return [i.variable.type.ndim for i in maker.inputs if not i.implicit]
+
+def _short_error(e):
+    #Theano errors go on with a dump of the node that failed
+    lines = str(e).strip().split('\n')
+    return lines[0]
+
+def _split(outputs):
+    if isinstance(outputs, list):
+        return [list(o) for o in zip(*outputs)]
+    return list(outputs)
+
+class MicroBatcher(object):
+    """Groups concurrent calls to a function into batches.
+    The first request of a batch waits at most max_latency seconds for other
+    requests to join it, and a batch never has more than max_batch_size
+    requests. Each batch is computed by a single thread, so the function
+    doesn't have to be thread safe.
+
+    :param fn: The function that computes the requests, like the one
+        returned by model.compile() or a nnb.utils.numpy_runtime.NumpyModel.
+        By default, the inputs of the requests of a batch are stacked along a
+        new first axis and fn is called once per batch, so it should take
+        batches of inputs and compute every row independently, like a
+        PerceptronLayer. The outputs are split along their first axis.
+    :param batch_fn: Optional function that computes a whole batch, used
+        instead of fn. It takes a list of requests, each a list of inputs, and
+        returns a list of outputs, one per request.
+    :param stack: If False, fn computes a single request and is called once
+        per request of a batch, so the requests are only grouped, not
+        batched. Default is True.
+    :param max_batch_size: The largest batch. Default is 32.
+    :param max_latency: The longest time, in seconds, a request waits for
+        other requests. Default is 0.005.
+    :param max_pending: The number of requests that can wait to be computed.
+        Requests beyond this are rejected with ServerBusy. Default is 1024.
+    :param window: The number of recent requests used in the latency metrics.
+    """
+
+    def __init__(self, fn=None, batch_fn=None, stack=True, max_batch_size=32,
+                max_latency=0.005, max_pending=1024, window=1000):
+        if fn is None and batch_fn is None:
+            raise ValueError("Either fn or batch_fn should be given")
+        self._ndims = None
+        if batch_fn is None:
+            self._ndims = _input_ndims(fn)
+            if stack:
+                batch_fn = self._stacked(fn)
+                if self._ndims is not None:
+                    self._ndims = [ndim - 1 for ndim in self._ndims]
+            else:
+                batch_fn = lambda batch: [fn(*inputs) for inputs in batch]
+        self._batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self._queue = Queue.Queue(maxsize=max_pending)
+        self._stopping = False
+
+        self._lock = threading.Lock()
+        self._start = time.time()
+        self._requests = 0
+        self._batches = 0
+        self._errors = 0
+        self._rejected = 0
+        self._abandoned = 0
+        self._latencies = collections.deque(maxlen=window)
+        self._batch_sizes = collections.deque(maxlen=window)
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @staticmethod
+    def _stacked(fn):
+        def batch_fn(batch):
+            #Only requests whose inputs have the same shapes can be stacked
+            groups = collections.OrderedDict()
+            for i, inputs in enumerate(batch):
+                key = tuple(np.shape(x) for x in inputs)
+                groups.setdefault(key, []).append(i)
+            outputs = [None] * len(batch)
+            for indexes in groups.values():
+                inputs = [np.asarray(x)
+                            for x in zip(*[batch[i] for i in indexes])]
+                for i, output in zip(indexes, _split(fn(*inputs))):
+                    outputs[i] = output
+            return outputs
+        return batch_fn
+
+    def _check(self, inputs):
+        if self._ndims is None:
+            return
+        if len(inputs) != len(self._ndims):
+            raise ValueError("Expected {0} inputs, got {1}".format(
+                                len(self._ndims), len(inputs)))
+        for i, (x, ndim) in enumerate(zip(inputs, self._ndims)):
+            x = np.asarray(x)
+            if x.dtype == object or x.ndim != ndim:
+                raise ValueError(("Input {0} should be an array with {1} " +
+                                "dimensions").format(i, ndim))
+
+    def submit(self, *inputs):
+        """Queues a request and returns an object whose wait method returns
+        the outputs. If fn is a theano function, inputs with the wrong number
+        of dimensions are rejected with a ValueError."""
+        if not self._thread.is_alive():
+            raise ValueError("The MicroBatcher is closed")
+        self._check(inputs)
+        request = _Request(list(inputs))
+        try:
+            self._queue.put(request, block=False)
+        except Queue.Full:
+            with self._lock:
+                self._rejected += 1
+            raise ServerBusy("Too many pending requests")
+        return request
+
+    def __call__(self, *inputs, **kwargs):
+        """Computes a request, blocking until its batch is computed.
+
+        :param timeout: Optional keyword argument. The longest time to wait,
+            in seconds.
+        """
+        return self.submit(*inputs).wait(kwargs.get('timeout'))
+
+    def _drop_abandoned(self, request):
+        """Tells if a request was abandoned by its caller, counting it"""
+        if request.abandoned:
+            with self._lock:
+                self._abandoned += 1
+        return request.abandoned
+
+    def _next_batch(self):
+        first = None
+        while first is None:
+            if self._stopping:
+                return None
+            first = self._queue.get()
+            if first is None:
+                return None
+            if self._drop_abandoned(first):
+                first = None
+        batch = [first]
+        deadline = first.arrival + self.max_latency
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            try:
+                if timeout > 0:
+                    request = self._queue.get(timeout=timeout)
+                else:
+                    request = self._queue.get(block=False)
+            except Queue.Empty:
+                break
+            if request is None:
+                #Compute this batch before stopping
+                self._stopping = True
+                break
+            if not self._drop_abandoned(request):
+                batch.append(request)
+        return batch
+
+    def _compute(self, batch):
+        """Computes a batch and returns the requests that were computed"""
+        try:
+            outputs = self._batch_fn([r.inputs for r in batch])
+            if len(outputs) != len(batch):
+                raise ValueError(("The batch function returned {0} " +
+                                "outputs for {1} requests").format(
+                                    len(outputs), len(batch)))
+        except Exception:
+            if len(batch) > 1:
+                #Compute the requests one by one, so a bad request doesn't
+                #fail the others
+                return [r for request in batch
+                        for r in self._compute([request])]
+            batch[0].set_result(error=sys.exc_info())
+            return []
+        for request, output in zip(batch, outputs):
+            request.set_result(output)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            computed = self._compute(batch)
+            done = time.time()
+            with self._lock:
+                self._requests += len(computed)
+                self._errors += len(batch) - len(computed)
+                self._batches += 1
+                if len(computed) > 0:
+                    self._batch_sizes.append(len(batch))
+                    self._latencies.extend(done - r.arrival
+                                            for r in computed)
+
+    def stats(self):
+        """Returns a dict of metrics: the number of computed requests, of
+        batches, of requests that failed, were rejected or were abandoned by
+        their callers before being computed, the throughput in
+        requests per second since the MicroBatcher started, and the mean batch
+        size and latencies (mean and percentiles, in milliseconds) of recent
+        requests."""
+        with self._lock:
+            latencies = np.asarray(self._latencies) * 1000.
+            sizes = list(self._batch_sizes)
+            stats = {
+                'requests': self._requests,
+                'batches': self._batches,
+                'errors': self._errors,
+                'rejected': self._rejected,
+                'abandoned': self._abandoned,
+                'pending': self._queue.qsize(),
+                'throughput': self._requests / (time.time() - self._start)
+            }
+        if len(sizes) > 0:
+            stats['mean_batch_size'] = float(np.mean(sizes))
+        if len(latencies) > 0:
+            stats['latency_ms'] = {
+                'mean': float(latencies.mean()),
+                'p50': float(np.percentile(latencies, 50)),
+                'p90': float(np.percentile(latencies, 90)),
+                'p99': float(np.percentile(latencies, 99)),
+                'max': float(latencies.max())
+            }
+        return stats
+
+    def close(self):
+        """Computes the pending requests and stops the batching thread."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+def _to_json(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (list, tuple)):
+        return [_to_json(v) for v in value]
+    return value
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def _reply(self, code, body):
+        data = json.dumps(body)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path != '/stats':
+            self._reply(404, {'error': 'Not found'})
+            return
+        self._reply(200, self.server.batcher.stats())
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self._reply(404, {'error': 'Not found'})
+            return
+        try:
+            length = int(self.headers.getheader('Content-Length', 0))
+            inputs = json.loads(self.rfile.read(length))['inputs']
+            if not isinstance(inputs, list):
+                raise ValueError("'inputs' should be a list")
+        except (ValueError, KeyError, TypeError) as e:
+            self._reply(400, {'error': str(e)})
+            return
+        try:
+            outputs = self.server.batcher(*inputs,
+                                        timeout=self.server.timeout_s)
+        except ServerBusy as e:
+            self._reply(503, {'error': str(e)})
+            return
+        except (ValueError, TypeError, IndexError) as e:
+            #Inputs of the wrong shape or type
+            self._reply(400, {'error': _short_error(e)})
+            return
+        except Exception as e:
+            self.log_error('%s', _short_error(e))
+            self._reply(500, {'error': 'Internal server error'})
+            return
+        self._reply(200, {'outputs': _to_json(outputs)})
+
+    def address_string(self):
+        #Unix sockets have no client address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(
+                self, format, *args)
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                            BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class _ThreadingUnixHTTPServer(SocketServer.ThreadingMixIn,
+                                SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+def make_server(batcher, host='127.0.0.1', port=8000, unix_socket=None,
+                timeout=30., verbose=False):
+    """Builds an HTTP server that answers requests with a MicroBatcher.
+    Each connection is handled by its own thread, which waits for the result
+    of its request, while the MicroBatcher computes the batches. Call the
+    server's serve_forever method to start it and shutdown to stop it.
+
+    :param host: The address to listen on. Default is localhost.
+    :param port: The TCP port. Use 0 to pick any free port, which can then be
+        read from server.server_address.
+    :param unix_socket: Optional path of a Unix socket to listen on instead
+        of a TCP port.
+    :param timeout: The longest time, in seconds, a request waits for its
+        result before the server answers 503.
+    :param verbose: If True, every request is logged to stderr.
+    """
+    if unix_socket is not None:
+        server = _ThreadingUnixHTTPServer(unix_socket, _Handler)
+    else:
+        server = _ThreadingHTTPServer((host, port), _Handler)
+    server.batcher = batcher
+    server.timeout_s = timeout
+    server.verbose = verbose
+    return server
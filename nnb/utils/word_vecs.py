@@ -15,10 +15,19 @@
 #   You should have received a copy of the GNU General Public License along with
 #   NNBlocks. If not, see http://www.gnu.org/licenses/.
 
+import os
+import mmap
+import heapq
+import hashlib
+import itertools
+import multiprocessing
+import collections
 import numpy as np
 import theano
 import nnb
 
+_CHUNK_LINES = 100000
+
 def is_number(s):
     try:
         float(s)
@@ -30,33 +39,151 @@ def is_number(s):
 def is_year(s):
     return s.isdigit() and 1800 <= int(s) <= 2030
 
+def _parse_lines(lines, separator):
+    """Parses a chunk of 'token<separator>value<separator>value...' lines.
+    The values of the whole chunk are parsed by a single numpy call.
+    """
+    tokens = []
+    values = []
+    for line in lines:
+        if line.isspace():
+            continue
+        token, rest = line.split(separator, 1)
+        tokens.append(token)
+        values.append(rest.rstrip())
+    vecs = np.fromstring(separator.join(values), sep=separator,
+                        dtype=theano.config.floatX)
+    if len(tokens) == 0 or vecs.size % len(tokens) != 0:
+        raise ValueError("Malformed word vectors file: the vectors don't " +
+                        "have the same size.")
+    return tokens, vecs.reshape((len(tokens), -1))
+
+def _read_documents(filename):
+    """Each line of the file is a document of whitespace separated tokens"""
+    with open(filename) as fin:
+        for line in fin:
+            yield line.split()
+
+def _count_tokens(sentences, lower):
+    """Counts the tokens of the sentences the way add_sentences does.
+    Raw tokens are counted first, so lowercasing and the year/number checks
+    only run once per distinct token.
+    """
+    raw = collections.Counter()
+    for sentence in sentences:
+        raw.update(sentence)
+
+    counts = {}
+    for token, n in raw.iteritems():
+        if lower:
+            token = token.lower()
+        if is_year(token) or is_number(token):
+            continue
+        counts[token] = counts.get(token, 0) + n
+    return counts
+
+def _count_shard(args):
+    filename, lower = args
+    return _count_tokens(_read_documents(filename), lower)
+
+_worker_helper = None
+
+def _init_translate_worker(word2index, lower):
+    global _worker_helper
+    _worker_helper = WordVecsHelper(lower=lower)
+    _worker_helper.word2index = word2index
+
+def _translate_shard(filename):
+    return _worker_helper.translate_corpus(_read_documents(filename))
+
+def _cache_is_fresh(filename, cache_files):
+    for cache_file in cache_files:
+        if not os.path.exists(cache_file) or \
+                os.path.getmtime(cache_file) < os.path.getmtime(filename):
+            return False
+    return True
+
 class WordVecsHelper:
     def __init__(self, lower=True):
         self.word_vecs = None
         self.word2index = None
         self.counter = {}
         self.lower = lower
+        self._translations = {}
+        self._translations_index = None
+        self._translations_key = None
 
     def add_sentences(self, sentences):
-        for sentence in sentences:
-            for word in sentence:
-                token = word
-                if self.lower:
-                    token = word.lower()
-                if is_year(token) or is_number(token):
-                    continue
-                if token not in self.counter:
-                    self.counter[token] = 0
-                self.counter[token] += 1
+        self._merge_counts(_count_tokens(sentences, self.lower))
 
-    def create(self, dim, threshold=0):
+    def _merge_counts(self, counts):
+        counter = self.counter
+        for token, n in counts.iteritems():
+            counter[token] = counter.get(token, 0) + n
+
+    def _prune_counts(self, min_count):
+        for token in [t for t, n in self.counter.iteritems() if n < min_count]:
+            del self.counter[token]
+
+    def add_files(self, filenames, processes=None, min_count=None,
+                max_size=None):
+        """Counts the words of corpus shards in parallel.
+        Each line of each file is a sentence with whitespace separated tokens.
+        Each file is counted by a worker process and the counts are merged
+        into the counter as they arrive, just as if add_sentences had been
+        called with every sentence.
+
+        :param processes: The number of worker processes. Default is the
+            number of CPUs. If set to 1, no worker process is started.
+        :param min_count: Optional int. After merging, words counted less than
+            min_count times are removed from the counter.
+        :param max_size: Optional int. Bounds the memory used by the merge.
+            Whenever the counter grows larger than max_size, the rarest words
+            are removed, like word2vec does: first the words counted once,
+            then, if that's not enough, the ones counted twice, and so on.
+            A word removed this way starts from zero if it shows up again in
+            a later shard, so the counts of rare words are approximate.
+        """
+        args = [(filename, self.lower) for filename in filenames]
+        pool = None
+        if processes == 1:
+            shard_counts = itertools.imap(_count_shard, args)
+        else:
+            pool = multiprocessing.Pool(processes=processes)
+            shard_counts = pool.imap_unordered(_count_shard, args)
+
+        try:
+            prune_threshold = 1
+            for counts in shard_counts:
+                self._merge_counts(counts)
+                if max_size is not None and len(self.counter) > max_size:
+                    #The words counted at most as many times as the
+                    #(max_size + 1)th most common one have to go
+                    cutoff = heapq.nlargest(max_size + 1,
+                                            self.counter.itervalues())[-1]
+                    prune_threshold = max(prune_threshold + 1, cutoff + 1)
+                    self._prune_counts(prune_threshold)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        if min_count is not None:
+            self._prune_counts(min_count)
+
+    def _build_index(self, threshold=0, top_k=None):
         word2index = {}
         word2index['NUMBER'] = 0
         word2index['YEAR'] = 1
         word2index['UNK'] = 2
         num_words = 3
 
-        for token in self.counter:
+        tokens = self.counter
+        if top_k is not None:
+            tokens = sorted(tokens, key=self.counter.get, reverse=True)
+            tokens = tokens[:top_k]
+
+        for token in tokens:
             if self.counter[token] <= threshold:
                 continue
             if is_year(token):
@@ -68,6 +195,11 @@ class WordVecsHelper:
                 word2index[token] = num_words
                 num_words += 1
 
+        return word2index
+
+    def create(self, dim, threshold=0):
+        word2index = self._build_index(threshold)
+        num_words = len(word2index)
 
         word_vecs = nnb.rng.normal(
             loc=0,
@@ -78,7 +210,120 @@ class WordVecsHelper:
         self.word2index = word2index
         return word_vecs,word2index
 
-    def translate_word(self, s):
+    def create_from_file(self, filename, separator='\t', threshold=0,
+                        top_k=None):
+        """Creates the word vectors of the counted vocabulary from a file.
+        The vocabulary is built from the words counted with add_sentences,
+        just like in the create method, optionally keeping only the top_k
+        most frequent words. The file, in the same format read_file reads, is
+        then streamed and only the vectors of words in the vocabulary are
+        parsed and kept. Words missing from the file are initialized the way
+        create initializes them.
+        If the helper lowercases words, a vector for the lowercase token is
+        preferred over the vectors of other casings.
+
+        :returns: A tuple with the word vectors matrix and the word2index
+            dict
+        """
+        word2index = self._build_index(threshold, top_k)
+        word_vecs = None
+        exact = None
+
+        with open(filename) as fin:
+            while True:
+                lines = list(itertools.islice(fin, _CHUNK_LINES))
+                if len(lines) == 0:
+                    break
+
+                if word_vecs is None:
+                    dim = _parse_lines(lines[:1], separator)[1].shape[1]
+                    word_vecs = nnb.rng.normal(
+                        loc=0,
+                        scale=1.0,
+                        size=(len(word2index), dim)
+                    ) / 10
+                    word_vecs = np.asarray(word_vecs,
+                                            dtype=theano.config.floatX)
+                    exact = np.zeros(len(word2index), dtype=bool)
+
+                hits = []
+                indexes = []
+                for line in lines:
+                    token = line[:line.find(separator)]
+                    key = token.lower() if self.lower else token
+                    index = word2index.get(key)
+                    if index is None or exact[index]:
+                        continue
+                    exact[index] = token == key
+                    hits.append(line)
+                    indexes.append(index)
+
+                if len(hits) > 0:
+                    word_vecs[indexes] = _parse_lines(hits, separator)[1]
+
+        self.word_vecs = word_vecs
+        self.word2index = word2index
+        return word_vecs, word2index
+
+    def _index_counts(self):
+        if self.word2index is None:
+            raise ValueError("The word indexes are not set. Call create or " +
+                            "read_file first.")
+        #Add-one smoothing, so words that were never counted can be predicted
+        counts = np.ones(len(self.word2index))
+        for token, index in self.word2index.items():
+            counts[index] += self.counter.get(token, 0)
+        return counts
+
+    def frequency_classes(self, num_classes, power=0.5):
+        """Assigns every word index to a class, based on word frequencies.
+        Words are sorted by frequency and split in consecutive classes holding
+        about the same mass of count ** power. A power of 0.5 gives classes of
+        balanced sizes and probabilities; a power of 0 gives classes with the
+        same number of words. The result can be used as the 'classes' option
+        of nnb.HierarchicalSoftmaxLayer.
+
+        :returns: A numpy ndarray with the class of each word index
+        """
+        weights = self._index_counts() ** power
+        order = np.argsort(-weights, kind='mergesort')
+        mass_before = np.cumsum(weights[order]) - weights[order]
+        classes = np.empty(len(weights), dtype='int32')
+        classes[order] = mass_before / weights.sum() * num_classes
+        #Renumber, so there are no empty classes
+        classes = np.unique(classes, return_inverse=True)[1]
+        return np.asarray(classes, dtype='int32')
+
+    def unigram_distribution(self, power=0.75):
+        """The unigram distribution of the word indexes, raised to `power` and
+        renormalized. The result can be used as the 'proposal' option of
+        nnb.SampledSoftmaxLayer.
+        """
+        weights = self._index_counts() ** power
+        return weights / weights.sum()
+
+    def _get_translations(self):
+        #The memoized translations are only valid for the current word2index.
+        #The dict itself is kept, so its id can't be reused by another one.
+        key = (len(self.word2index), self.lower)
+        if self._translations_index is not self.word2index or \
+                self._translations_key != key:
+            self._translations = {}
+            self._translations_index = self.word2index
+            self._translations_key = key
+        return self._translations
+
+    def reset_translations(self):
+        """Forgets the memoized translations.
+        The translations are memoized for the current word2index and are
+        forgotten when word2index is replaced or words are added to it. Call
+        this after changing the index of a word already in word2index.
+        """
+        self._translations = {}
+        self._translations_index = None
+        self._translations_key = None
+
+    def _normalize(self, s):
         if self.lower:
             s = s.lower()
 
@@ -90,49 +335,231 @@ class WordVecsHelper:
             s = 'UNK'
 
         return self.word2index[s]
-        
+
+    def translate_word(self, s):
+        translations = self._get_translations()
+        index = translations.get(s)
+        if index is None:
+            index = self._normalize(s)
+            translations[s] = index
+        return index
+
     def translate(self, l):
         if isinstance(l, str):
             return self.translate_word(l)
 
-        r = []
-        for s in l:
-            r.append(self.translate_word(s))
+        translations = self._get_translations()
+        translate_word = self.translate_word
+        return [translations[s] if s in translations else translate_word(s)
+                for s in l]
 
-        return r
+    def translate_corpus(self, documents):
+        """Translates many documents at once.
+        Each distinct token is only normalized once, no matter how many times
+        it appears in the corpus.
 
-    def read_file(self, filename, separator='\t'):
-        line_counts = 1
-        word_dim = None
-        with open(filename) as fin:
-            line = fin.readline()
-            splits = line.split(separator)
-            word_dim = len(splits) - 1
-            for line in fin:
-                line_counts += 1
+        :param documents: An iterable of documents, each a list of tokens
+        :returns: A tuple (values, offsets) of numpy arrays. values is an int32
+            array with the indexes of every token of every document, one
+            document after the other. The indexes of the document i are
+            values[offsets[i]:offsets[i + 1]].
+        """
+        values = []
+        lengths = [0]
+        for document in documents:
+            indexes = self.translate(document)
+            values.extend(indexes)
+            lengths.append(len(indexes))
+
+        values = np.asarray(values, dtype='int32')
+        offsets = np.cumsum(lengths, dtype='int64')
+        return values, offsets
+
+    def translate_files(self, filenames, processes=None):
+        """Translates corpus shards in parallel.
+        Each line of each file is a document with whitespace separated
+        tokens. The files are translated by a pool of worker processes.
 
+        :param filenames: List of file names
+        :param processes: The number of worker processes. Default is the
+            number of CPUs. If set to 1, no worker process is started.
+        :returns: A tuple (values, offsets) just like translate_corpus, with
+            the documents of every file in the order the files were given.
+        """
+        if processes == 1:
+            results = [self.translate_corpus(_read_documents(filename))
+                        for filename in filenames]
+        else:
+            pool = multiprocessing.Pool(
+                processes=processes,
+                initializer=_init_translate_worker,
+                initargs=(self.word2index, self.lower)
+            )
+            try:
+                results = pool.map(_translate_shard, filenames)
+            finally:
+                pool.close()
+                pool.join()
 
+        if len(results) == 0:
+            return np.zeros(0, dtype='int32'), np.zeros(1, dtype='int64')
+
+        values = np.concatenate([r[0] for r in results])
+        offsets = [results[0][1]]
+        for r in results[1:]:
+            offsets.append(r[1][1:] + offsets[-1][-1])
+        offsets = np.concatenate(offsets)
+        return values, offsets
+
+    def read_file(self, filename, separator='\t', cache=False, mmap_mode='c'):
+        """Reads word vectors from a text file.
+        Each line of the file should be a token followed by the values of its
+        vector, all separated by `separator`. An 'UNK' vector is added with
+        index 0.
+
+        :param cache: If True, the vectors are also written to a binary cache
+            next to the file (filename.KEY.npy with the vectors and
+            filename.KEY.vocab with the tokens, where KEY identifies the
+            separator and theano.config.floatX). On later calls with the same
+            separator and floatX the cache is used instead of the text file,
+            as long as it is newer than the text file.
+        :param mmap_mode: The mode used to memory-map the cached vectors (see
+            numpy.load). The default 'c' is copy-on-write, so pages are shared
+            between processes until they are modified. Set it to None to read
+            the whole matrix into memory.
+        :returns: A tuple with the word vectors matrix and the word2index
+            dict
+        """
+        key = hashlib.sha1(repr((separator, theano.config.floatX)))
+        cache_name = '{0}.{1}'.format(filename, key.hexdigest()[:10])
+        cache_npy = cache_name + '.npy'
+        cache_vocab = cache_name + '.vocab'
         nnb.rng = np.random.RandomState(16927361)
 
-        #UNK
-        line_counts += 1
-        word_vecs = np.empty(
-            shape=(line_counts, word_dim),
-            dtype=theano.config.floatX
-        )
-        word_vecs[0, :] = nnb.rng.normal(loc=0., scale=1., size=(1, word_dim)) / 10
+        if cache and _cache_is_fresh(filename, [cache_npy, cache_vocab]):
+            word_vecs = np.load(cache_npy, mmap_mode=mmap_mode)
+            with open(cache_vocab) as fin:
+                tokens = fin.read().split('\n')
+            #Same random state as if the file had been parsed
+            nnb.rng.normal(loc=0., scale=1., size=(1, word_vecs.shape[1]))
+        else:
+            word_vecs, tokens = self._parse_file(filename, separator)
+            if cache:
+                tmp_npy = cache_npy + '.tmp.npy'
+                np.save(tmp_npy, word_vecs)
+                tmp_vocab = cache_vocab + '.tmp'
+                with open(tmp_vocab, 'w') as fout:
+                    fout.write('\n'.join(tokens))
+                os.rename(tmp_npy, cache_npy)
+                os.rename(tmp_vocab, cache_vocab)
+
+        self.word2index = dict(itertools.izip(tokens, xrange(len(tokens))))
+        self.word_vecs = word_vecs
+
+        return self.word_vecs, self.word2index
+
+    def _parse_file(self, filename, separator):
+        tokens = ['UNK']
+        word_vecs = None
 
-        word2index = {}
-        word2index['UNK'] = 0
         with open(filename) as fin:
-            for line in fin:
-                splits = line.split(separator)
-                token = splits[0]
-                vec = map(float, splits[1:])
-                word_vecs[len(word2index), :] = vec
-                word2index[token] = len(word2index)
+            while True:
+                lines = list(itertools.islice(fin, _CHUNK_LINES))
+                if len(lines) == 0:
+                    break
+                chunk_tokens, chunk_vecs = _parse_lines(lines, separator)
+                if word_vecs is None:
+                    word_dim = chunk_vecs.shape[1]
+                    #UNK
+                    word_vecs = np.empty(
+                        shape=(len(lines) + 1, word_dim),
+                        dtype=theano.config.floatX
+                    )
+                    word_vecs[0, :] = nnb.rng.normal(
+                        loc=0., scale=1., size=(1, word_dim)) / 10
+                start = len(tokens)
+                end = start + len(chunk_tokens)
+                if end > len(word_vecs):
+                    #The buffer doubles, so each row is copied O(1) times
+                    grown = np.empty(
+                        shape=(max(end, 2 * len(word_vecs)), word_dim),
+                        dtype=word_vecs.dtype
+                    )
+                    grown[:start] = word_vecs[:start]
+                    word_vecs = grown
+                word_vecs[start:end] = chunk_vecs
+                tokens += chunk_tokens
 
-        self.word2index = word2index
-        self.word_vecs = word_vecs
+        #Gives the unused rows back instead of keeping a view of the buffer
+        word_vecs.resize((len(tokens), word_vecs.shape[1]), refcheck=False)
+        return word_vecs, tokens
 
-        return word_vecs, word2index
+    def read_word2vec(self, filename):
+        """Reads word vectors in word2vec's binary format.
+        The format is a 'words_nr dim' header line followed, for every word,
+        by the word, a space and the dim float32 values of its vector. The
+        values are copied straight from the file buffer without any parsing.
+        Just like in read_file, if the file has no 'UNK' word an 'UNK' vector
+        is added with index 0.
+
+        :returns: A tuple with the word vectors matrix and the word2index
+            dict
+        """
+        with open(filename, 'rb') as fin:
+            header = fin.readline()
+            words_nr, dim = [int(n) for n in header.split()]
+            data = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            nnb.rng = np.random.RandomState(16927361)
+            word_vecs = np.empty(shape=(words_nr + 1, dim), dtype='<f4')
+            tokens = []
+            offset = len(header)
+            row_bytes = 4 * dim
+            for i in xrange(1, words_nr + 1):
+                end = data.find(' ', offset)
+                if end < 0:
+                    raise ValueError("Malformed word2vec file: expected " +
+                                    "{0} words, found {1}.".format(words_nr,
+                                                                    i - 1))
+                #word2vec writes a new line after each vector
+                tokens.append(data[offset:end].lstrip('\n'))
+                word_vecs[i] = np.frombuffer(data, dtype='<f4', count=dim,
+                                            offset=end + 1)
+                offset = end + 1 + row_bytes
+        finally:
+            data.close()
+
+        if 'UNK' in tokens:
+            word_vecs = word_vecs[1:]
+        else:
+            word_vecs[0] = nnb.rng.normal(loc=0., scale=1., size=(dim,)) / 10
+            tokens = ['UNK'] + tokens
+
+        self.word2index = dict(itertools.izip(tokens, xrange(len(tokens))))
+        self.word_vecs = np.asarray(word_vecs, dtype=theano.config.floatX)
+
+        return self.word_vecs, self.word2index
+
+    def write_word2vec(self, filename):
+        """Writes the word vectors in word2vec's binary format.
+        Every index of word2index is written, including 'UNK', 'NUMBER' and
+        'YEAR' if they are set, so read_word2vec gives back the same indexes.
+        """
+        if self.word_vecs is None or self.word2index is None:
+            raise ValueError("There are no word vectors to write. Call " +
+                            "create or read_file first.")
+        word_vecs = np.asarray(self.word_vecs, dtype='<f4')
+        index2word = [None] * word_vecs.shape[0]
+        for token, index in self.word2index.items():
+            if isinstance(token, unicode):
+                token = token.encode('utf-8')
+            index2word[index] = token
+
+        with open(filename, 'wb') as fout:
+            fout.write('{0} {1}\n'.format(*word_vecs.shape))
+            for token, vec in itertools.izip(index2word, word_vecs):
+                fout.write(token)
+                fout.write(' ')
+                fout.write(vec.tostring())
+                fout.write('\n')